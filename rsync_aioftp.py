@@ -0,0 +1,462 @@
+import asyncio
+import hashlib
+import os
+import posixpath
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import aioftp
+import ftputil.error
+import ftputil.stat
+import rsync_ftp as ftp
+import rsync_hash
+import rsync_metrics as metrics
+from rsync_ftp import extract_path, extract_connection_information
+from rsync_manifest import Manifest
+
+# these operations do one request at a time, so the ftputil ones are used for this backend too
+ftp_exists = ftp.ftp_exists
+get_hash = ftp.get_hash
+get_last_modification_date_of_file = ftp.get_last_modification_date_of_file
+open_file = ftp.open_file
+write_file = ftp.write_file
+iter_entries = ftp.iter_entries
+rename_file = ftp.rename_file
+rename_files = ftp.rename_files
+
+storage_path: str = "E:\\Info\\FACULTATE\\ANUL_3\\PYTHON\\PROIECT\\Advanced RSync\\storage"
+
+concurrency: int = 32
+"""the maximum number of ftp operations (and control connections) running at the same time for a server"""
+
+_loop = None
+"""the event loop running on a background thread, kept between calls so the connections can be reused"""
+
+_loop_lock = threading.Lock()
+
+_pools = {}
+"""maps a (hostname, username) key to the ClientPool of that server, only used from the event loop thread"""
+
+_list_parsers = [ftputil.stat.UnixParser(), ftputil.stat.MSParser()]
+"""the LIST parsers of ftputil, tried in this order like FTPHost does, so both backends get the same metadata"""
+
+
+def run(coroutine):
+    """This method runs the coroutine given as parameter on the background event loop and returns its result"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coroutine, _loop).result()
+
+
+class ClientPool:
+    """This class keeps logged in aioftp clients for a ftp server so their control connections are reused.
+    At most concurrency clients are used at the same time, the other operations wait for one of them."""
+
+    def __init__(self, ftp_url: str):
+        """Constructor that creates an empty pool for the server of the ftp url given as parameter"""
+        self.hostname, self.username, self.password = extract_connection_information(ftp_url)
+        self.port = aioftp.DEFAULT_PORT
+        if ':' in self.hostname:
+            self.hostname, port = self.hostname.rsplit(':', 1)
+            self.port = int(port)
+        self._idle = []
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def acquire(self):
+        """This method returns a logged in client, reusing an idle one if possible"""
+        await self._semaphore.acquire()
+        if self._idle:
+            return self._idle.pop()
+        client = aioftp.Client()
+        metrics.count('ftp', 'connections')
+        try:
+            await client.connect(self.hostname, self.port)
+            await client.login(self.username, self.password)
+        except BaseException:
+            client.close()
+            self._semaphore.release()
+            raise
+        return client
+
+    def release(self, client, broken: bool = False):
+        """This method gives back the client given as parameter, closing it if it is broken"""
+        if broken:
+            client.close()
+        else:
+            self._idle.append(client)
+        self._semaphore.release()
+
+    async def close(self):
+        """This method logs out all the idle clients"""
+        while self._idle:
+            client = self._idle.pop()
+            try:
+                await client.quit()
+            except BaseException:
+                client.close()
+
+
+class Borrowed:
+    """This class is used in an async with statement to borrow a client from a pool.
+    The client is closed instead of being given back if an error happened, as its connection state is unknown."""
+
+    def __init__(self, pool: ClientPool):
+        self.pool = pool
+        self.client = None
+
+    async def __aenter__(self):
+        self.client = await self.pool.acquire()
+        return self.client
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.pool.release(self.client, broken=exc_type is not None)
+
+
+def get_pool(ftp_url: str):
+    """This method returns the ClientPool of the server of the ftp url given as parameter, creating it if needed.
+    It must be called from the event loop thread."""
+    hostname, username, password = extract_connection_information(ftp_url)
+    key = (hostname, username)
+    if key not in _pools:
+        _pools[key] = ClientPool(ftp_url)
+    return _pools[key]
+
+
+def parse_list_line(line: str):
+    """This method returns the ftputil StatResult of a line from a LIST listing, parsed like FTPHost parses it,
+    OR None for the lines which are not about a file, like 'total 8'.
+    The modification times are then the same as the ones of the rsync_ftp backend, with the same precision,
+    so the manifests and the snapshots do not change when the backend does."""
+    for parser in _list_parsers:
+        if parser.ignores_line(line):
+            return None
+        try:
+            return parser.parse_line(line)
+        except ftputil.error.ParserError:
+            continue
+    return None
+
+
+async def list_tree(ftp_url: str, path: str):
+    """This method lists all the directories under the path given as parameter at the same time
+    and returns a list of (root, dirs, files) tuples in the same top down order as FTPHost.walk,
+    where dirs is a list of (name, modification time) tuples and files is a list of
+    (name, size, modification time) tuples."""
+    pool = get_pool(ftp_url)
+    listings = {}
+
+    async def list_directory(top):
+        dirs, files = [], []
+        async with Borrowed(pool) as client:
+            async with client.get_stream('LIST ' + top, '1xx') as stream:
+                listing = (await stream.read()).decode(client.encoding)
+        for line in listing.splitlines():
+            result = parse_list_line(line)
+            if result is None or result._st_name in ('.', '..'):
+                continue
+            if stat.S_ISDIR(result.st_mode):
+                dirs.append((result._st_name, result.st_mtime))
+            else:
+                files.append((result._st_name, result.st_size, result.st_mtime))
+        listings[top] = (dirs, files)
+        await asyncio.gather(*[list_directory(posixpath.join(top, directory[0])) for directory in dirs])
+
+    await list_directory(path)
+
+    walk = []
+    stack = [path]
+    while stack:
+        top = stack.pop()
+        dirs, files = listings[top]
+        walk.append((top, dirs, files))
+        stack.extend(posixpath.join(top, directory[0]) for directory in reversed(dirs))
+    return walk
+
+
+async def server_capabilities(pool: ClientPool, client):
+    """This method returns the set of hashing commands supported by the server of the pool given as parameter,
+    asking it with the client given as parameter. The result is cached with the ones of rsync_ftp.server_capabilities,
+    so the FEAT command is sent only once for each host whatever the backend."""
+    host = (pool.hostname, pool.port)
+    with ftp._capabilities_lock:
+        if host in ftp._capabilities:
+            return ftp._capabilities[host]
+    try:
+        code, info = await client.command('FEAT', '2xx')
+    except aioftp.StatusCodeError:
+        info = []
+    features = ftp.parse_features(info[1:-1])
+    with ftp._capabilities_lock:
+        ftp._capabilities[host] = features
+    return features
+
+
+async def server_digest(pool: ClientPool, client, remote_path: str, algorithms=None):
+    """This method is the rsync_ftp.server_digest of this backend: it asks the server to hash the file at remote_path
+    with the client given as parameter and returns an (algorithm, hex digest) tuple, using the first algorithm from
+    the algorithms parameter (all of them by default) that the server supports, OR None if it supports none of them."""
+    if not ftp.server_hashing:
+        return None
+    for algorithm, commands, digits in ftp.hash_requests(await server_capabilities(pool, client), remote_path,
+                                                         algorithms):
+        try:
+            for command in commands:
+                code, info = await client.command(command, '2xx')
+        except aioftp.StatusCodeError:
+            continue
+        digest = ftp.parse_digest(' '.join(info), digits, commands[-1].startswith('HASH '))
+        if digest is not None:
+            return algorithm, digest
+    return None
+
+
+async def stream_digest(client, remote_path: str, digest):
+    """This method updates the hashlib object given as parameter with the file at remote_path
+    streamed from the server"""
+    async with client.download_stream(remote_path) as stream:
+        async for block in stream.iter_by_block(rsync_hash.buffer_size):
+            digest.update(block)
+            metrics.add_bytes('ftp', read=len(block))
+
+
+async def hash_remote_file(ftp_url: str, remote_path: str):
+    """This method returns the hash of the file at remote_path, computed by the ftp server if it supports it
+    like in rsync_ftp.hash_file, otherwise streamed from the server"""
+    pool = get_pool(ftp_url)
+    async with Borrowed(pool) as client:
+        digest = await server_digest(pool, client, remote_path, [rsync_hash.algorithm])
+        if digest is not None:
+            return rsync_hash.label(digest[1])
+        file_digest = rsync_hash.new()
+        await stream_digest(client, remote_path, file_digest)
+    return rsync_hash.label(file_digest.hexdigest())
+
+
+async def same_content(pool: ClientPool, client, remote_path: str, local_path: str):
+    """This method is the rsync_ftp.same_content of this backend. The local file is hashed on another thread,
+    so the other transfers go on meanwhile."""
+    digest = await server_digest(pool, client, remote_path)
+    if digest is not None:
+        algorithm, remote_hash = digest
+        return remote_hash == await asyncio.to_thread(ftp.local_digest, local_path, algorithm)
+    hash_md5 = hashlib.md5()
+    await stream_digest(client, remote_path, hash_md5)
+    return hash_md5.hexdigest() == await asyncio.to_thread(ftp.local_digest, local_path, 'md5')
+
+
+def relative_path(path: str, root: str, name: str):
+    """This method returns the relative path from path of the name inside root, with the get files list syntax"""
+    prefix = root.removeprefix(path).replace('\\', '/')
+    return prefix + '/' + name if len(prefix) > 0 else name
+
+
+def get_files_list(ftp_url, workers: int = 1):
+    """This method returns the same list as rsync_ftp.get_files_list, listing all the directories concurrently.
+    The workers parameter is not used, the concurrency module variable limits the parallel operations."""
+    path = extract_path(ftp_url)
+
+    async def files_list():
+        files_list = []
+        for root, dirs, files in await list_tree(ftp_url, path):
+            files_list.extend(relative_path(path, root, file[0]) for file in files)
+            files_list.extend(relative_path(path, root, directory[0]) + '/' for directory in dirs)
+        return files_list
+
+    return run(files_list())
+
+
+def stat_snapshot(ftp_url: str):
+    """This method returns the same dictionary as rsync_ftp.stat_snapshot, listing all the directories concurrently
+    and parsing the metadata from their LIST listings like ftputil does."""
+    path = extract_path(ftp_url)
+
+    async def snapshot():
+        snapshot = {}
+        for root, dirs, files in await list_tree(ftp_url, path):
+            for name, size, mtime in files:
+                snapshot[relative_path(path, root, name)] = [size, mtime, 'file']
+            for directory, mtime in dirs:
+                snapshot[relative_path(path, root, directory) + '/'] = [0, mtime, 'directory']
+        return snapshot
+
+    return run(snapshot())
+
+
+def get_files_with_hash(ftp_url, workers: int = 1, manifest: Manifest = None):
+    """This method returns the same list as rsync_ftp.get_files_with_hash, listing the directories
+    and hashing the files concurrently. The workers parameter is not used, the concurrency module variable
+    limits the parallel operations. If a manifest is given, only the files whose size or modification time
+    changed are read."""
+    path = extract_path(ftp_url)
+
+    async def file_hash(entry, remote_path, size, mtime):
+        if manifest is not None:
+            entry[1] = manifest.get_hash(entry[0], size, mtime)
+            if entry[1] is not None:
+                return
+        entry[1] = await hash_remote_file(ftp_url, remote_path)
+        if manifest is not None:
+            manifest.set_hash(entry[0], size, mtime, entry[1])
+
+    async def files_with_hash():
+        files_list = []
+        hashing = []
+        for root, dirs, files in await list_tree(ftp_url, path):
+            for name, size, mtime in files:
+                files_list.append([relative_path(path, root, name), None])
+                hashing.append(file_hash(files_list[-1], posixpath.join(root, name), size, mtime))
+            for directory in dirs:
+                files_list.append([relative_path(path, root, directory[0]) + '/', "directory"])
+        await asyncio.gather(*hashing)
+        return files_list
+
+    files_list = run(files_with_hash())
+    if manifest is not None:
+        manifest.forget_unseen()
+    return files_list
+
+
+async def download(ftp_url: str, file: str):
+    """This method copies the file given as parameter from the ftp server to the storage, like
+    rsync_ftp.resumable_download: the bytes are written to a '.part' file, a dropped download is resumed from its end
+    and it is moved in place only after its size, and its hash if it was resumed or verify_hash is set, matched."""
+    remote_path = (extract_path(ftp_url) + file).removesuffix('/')
+    local_path = storage_path.replace('\\', '/') + '/' + file.removesuffix('/')
+    part_path = local_path + '.part'
+    pool = get_pool(ftp_url)
+    async with Borrowed(pool) as client:
+        info = await client.stat(remote_path)
+        if info['type'] == 'dir':
+            os.makedirs(local_path, exist_ok=True)
+            return
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        size = int(info['size'])
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset > size:
+            offset = 0
+        if offset < size or not os.path.exists(part_path):
+            with open(part_path, 'r+b' if offset else 'wb') as target:
+                target.seek(offset)
+                target.truncate()
+                async with client.download_stream(remote_path, offset=offset) as stream:
+                    async for block in stream.iter_by_block(ftp._chunk_size):
+                        target.write(block)
+            metrics.add_bytes('ftp', read=size - offset)
+        if os.path.getsize(part_path) != size:
+            raise EOFError(f"Incomplete download of {remote_path}")
+        if (ftp.verify_hash or offset > 0) and not await same_content(pool, client, remote_path, part_path):
+            os.remove(part_path)
+            raise EOFError(f"Corrupted download of {remote_path}")
+    os.replace(part_path, local_path)
+
+
+async def upload(ftp_url: str, file: str):
+    """This method copies the file given as parameter from the storage to the ftp server, like
+    rsync_ftp.resumable_upload: the bytes are written to a '.part' file, a dropped upload is resumed from its end
+    and it is renamed in place only after its size, and its hash if it was resumed or verify_hash is set, matched."""
+    remote_path = (extract_path(ftp_url) + file).removesuffix('/')
+    local_path = storage_path + '\\' + file
+    part_path = remote_path + '.part'
+    pool = get_pool(ftp_url)
+    async with Borrowed(pool) as client:
+        if os.path.isdir(local_path):
+            await client.make_directory(remote_path)
+            return
+        if posixpath.dirname(remote_path) not in ('', '/'):
+            await client.make_directory(posixpath.dirname(remote_path))
+        size = os.path.getsize(local_path)
+        exists = await client.exists(part_path)
+        offset = int((await client.stat(part_path))['size']) if exists else 0
+        if offset > size:
+            offset = 0
+        if offset < size or not exists:
+            with open(local_path, 'rb') as source:
+                source.seek(offset)
+                async with client.upload_stream(part_path, offset=offset) as stream:
+                    for chunk in iter(lambda: source.read(ftp._chunk_size), b""):
+                        await stream.write(chunk)
+            metrics.add_bytes('ftp', written=size - offset)
+        if int((await client.stat(part_path))['size']) != size:
+            raise EOFError(f"Incomplete upload of {remote_path}")
+        if (ftp.verify_hash or offset > 0) and not await same_content(pool, client, part_path, local_path):
+            await client.remove(part_path)
+            raise EOFError(f"Corrupted upload of {remote_path}")
+        if await client.exists(remote_path):
+            await client.remove(remote_path)
+        await client.rename(part_path, remote_path)
+
+
+async def remove(ftp_url: str, file: str):
+    """This method deletes the file or folder given as parameter from the ftp server"""
+    remote_path = (extract_path(ftp_url) + file).removesuffix('/')
+    async with Borrowed(get_pool(ftp_url)) as client:
+        if await client.exists(remote_path):
+            await client.remove(remote_path)
+
+
+def run_all(operation, ftp_url: str, files):
+    """This method runs the async operation given as parameter for all the files at the same time.
+    Each one is retried by rsync_ftp.with_retries when its connection fails, like the transfers of that backend,
+    so a thread waits for each of them while the event loop runs them concurrently."""
+    files = list(files)
+    if not files:
+        return
+
+    def run_with_retries(file):
+        ftp.with_retries(lambda: run(operation(ftp_url, file)))
+
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(files))) as executor:
+        list(executor.map(run_with_retries, files))
+
+
+def copy_to_storage(ftp_url: str, file: str, wrap=None):
+    """This method copies the file given as parameter from the ftp server at the url given as parameter to the storage
+    If the file is a folder, it copies the files inside it. The wrap parameter is not used, as a stream which waits
+    would block the event loop, so the bytes of this backend are only known when the copy ended."""
+    run_all(download, ftp_url, [file])
+
+
+def copy_files_to_storage(ftp_url: str, files):
+    """This method copies all the files given as parameter from the ftp server to the storage concurrently"""
+    run_all(download, ftp_url, files)
+
+
+def copy_from_storage(ftp_url: str, file: str, wrap=None):
+    """This method copies the file given as parameter from the storage to the ftp server at the url given as parameter
+    If the file is a folder, it creates it. The wrap parameter is not used, like in copy_to_storage."""
+    run_all(upload, ftp_url, [file])
+
+
+def copy_files_from_storage(ftp_url: str, files):
+    """This method copies all the files given as parameter from the storage to the ftp server concurrently.
+    The folders are created before the files, so they exist when their files are uploaded."""
+    files = list(files)
+    run_all(upload, ftp_url, [file for file in files if file.endswith('/')])
+    run_all(upload, ftp_url, [file for file in files if not file.endswith('/')])
+
+
+def delete_file(ftp_url: str, file: str):
+    """This method deletes the file given as parameter from the ftp server at the url given as parameter
+    If the file is a folder, it deletes all the the files inside it."""
+    run_all(remove, ftp_url, [file])
+
+
+def delete_files(ftp_url: str, files):
+    """This method deletes all the files given as parameter from the ftp server concurrently"""
+    run_all(remove, ftp_url, files)
+
+
+def close_connections():
+    """This method logs out all the pooled clients. It must be called when the synchronisation ends."""
+    if _loop is None:
+        return
+
+    async def close_pools():
+        for pool in _pools.values():
+            await pool.close()
+        _pools.clear()
+
+    run(close_pools())
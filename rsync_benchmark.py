@@ -0,0 +1,295 @@
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+import zipfile as zip
+import rsync_ftp as ftp
+import rsync_hash
+import rsync_zip
+
+
+def time_call(function, *args):
+    """This method calls the function given as parameter with the args given as parameter
+    and returns a (seconds elapsed, result) tuple."""
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def benchmark_ftp_workers(ftp_url: str, workers_counts, repeat: int = 1):
+    """This method times ftp.get_files_with_hash for the ftp location url given as parameter
+    once for each workers count in workers_counts, checking that every result is the same as the serial one.
+    It returns a list of [workers, best seconds, speedup over the serial run] lists."""
+    ftp.configure_pool(max_size=max(workers_counts))
+    serial_seconds, expected = time_call(ftp.get_files_with_hash, ftp_url, 1)
+    results = []
+    for workers in workers_counts:
+        best = serial_seconds if workers == 1 else None
+        for _ in range(repeat):
+            seconds, files_list = time_call(ftp.get_files_with_hash, ftp_url, workers)
+            if files_list != expected:
+                raise AssertionError(f"The result with {workers} workers is different from the serial one")
+            if best is None or seconds < best:
+                best = seconds
+        results.append([workers, best, serial_seconds / best])
+    return results
+
+
+def generate_tree(root: str, files: int, min_size: int, max_size: int, depth: int, seed: int = 0):
+    """This method creates files random files in the root directory given as parameter, spread in directories
+    up to depth levels deep, with sizes between min_size and max_size bytes, most of them small like in real trees.
+    The same seed always creates the same tree. It returns the list of the files relative paths."""
+    generator = random.Random(seed)
+    directories = ['']
+    for level in range(depth):
+        for index in range(max(1, files // (10 * (level + 1)))):
+            parent = generator.choice(directories)
+            if parent.count('/') < depth:
+                directories.append(f"{parent}d{level}_{index}/")
+    paths = []
+    for index in range(files):
+        path = f"{generator.choice(directories)}f{index}.bin"
+        # a log uniform distribution, so there are many small files and a few big ones
+        size = int(min_size * (max_size / max(min_size, 1)) ** generator.random()) if max_size > min_size else min_size
+        os.makedirs(os.path.join(root, os.path.dirname(path)), exist_ok=True)
+        with open(os.path.join(root, path), 'wb') as file:
+            file.write(generator.randbytes(size))
+        paths.append(path)
+    return paths
+
+
+def zip_tree(root: str, zip_path: str):
+    """This method creates the zip at zip_path with all the files and directories of the root directory"""
+    with zip.ZipFile(zip_path, 'w', zip.ZIP_DEFLATED) as archive:
+        for directory, dirs, files in os.walk(root):
+            for name in sorted(dirs):
+                path = os.path.join(directory, name)
+                archive.write(path, os.path.relpath(path, root).replace('\\', '/') + '/')
+            for name in sorted(files):
+                path = os.path.join(directory, name)
+                archive.write(path, os.path.relpath(path, root).replace('\\', '/'))
+
+
+def set_storage_path(storage: str):
+    """This method makes all the location modules use the storage directory given as parameter,
+    the asyncio ftp backend too when the aioftp package is installed"""
+    import rsync_location
+    for module in (ftp, rsync_zip, rsync_location.folder):
+        module.storage_path = storage
+    try:
+        import rsync_aioftp
+    except ImportError:
+        return
+    rsync_aioftp.storage_path = storage
+
+
+def measure(results: list, backend: str, operation: str, repeat: int, function, *args):
+    """This method calls the function given as parameter repeat times, adds its timings to the results list
+    and returns the result of the last call."""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        seconds, result = time_call(function, *args)
+        timings.append(seconds)
+    results.append({
+        'backend': backend,
+        'operation': operation,
+        'seconds': timings,
+        'best': min(timings),
+        'median': statistics.median(timings),
+    })
+    return result
+
+
+def benchmark_location(results: list, backend: str, location, empty, sample, repeat: int):
+    """This method times all the operations of the location given as parameter and adds them to the results list.
+    The sample files are copied to the storage, back into the location, and deleted. The empty location is
+    the destination of sync_to and it is emptied before each run."""
+    measure(results, backend, 'get_files_list', repeat, location.get_files_list)
+    measure(results, backend, 'get_files_with_hash', repeat, location.get_files_with_hash)
+    measure(results, backend, 'get_hash', repeat, location.get_hash)
+    measure(results, backend, 'copy_file_to_storage', 1, location.copy_files_to_storage, sample)
+    measure(results, backend, 'copy_file_from_storage', 1, location.copy_files_from_storage, sample)
+    measure(results, backend, 'delete_file', 1, location.delete_files, sample)
+    location.copy_files_from_storage(sample)
+    timings = []
+    for _ in range(repeat):
+        empty.delete_files([path for path in empty.get_files_list() if '/' not in path.rstrip('/')])
+        timings.append(time_call(location.sync_to, empty)[0])
+    results.append({'backend': backend, 'operation': 'sync_to', 'seconds': timings,
+                    'best': min(timings), 'median': statistics.median(timings)})
+
+
+def run_suite(files: int, min_size: int, max_size: int, depth: int, repeat: int, backends, latency: float,
+              sample_size: int, seed: int):
+    """This method generates a synthetic tree, benchmarks it on each backend given as parameter
+    ('folder', 'zip' or 'ftp') and returns the report as a dictionary which can be saved as JSON."""
+    # imported here, so the hashing and ftp-workers benchmarks do not need all the location modules
+    from rsync_location import Location
+    results = []
+    work = tempfile.mkdtemp(prefix='rsync_benchmark_')
+    try:
+        tree = os.path.join(work, 'tree')
+        paths = generate_tree(tree, files, min_size, max_size, depth, seed)
+        sample = random.Random(seed).sample(paths, min(sample_size, len(paths)))
+        storage = os.path.join(work, 'storage')
+        os.makedirs(storage)
+        set_storage_path(storage)
+
+        if 'folder' in backends:
+            folder_path = os.path.join(work, 'folder')
+            shutil.copytree(tree, folder_path)
+            os.makedirs(os.path.join(work, 'folder_empty'))
+            benchmark_location(results, 'folder', Location('folder:' + folder_path),
+                               Location('folder:' + os.path.join(work, 'folder_empty')), sample, repeat)
+
+        if 'zip' in backends:
+            zip_path = os.path.join(work, 'tree.zip')
+            zip_tree(tree, zip_path)
+            empty_zip = os.path.join(work, 'empty.zip')
+            zip.ZipFile(empty_zip, 'w').close()
+            benchmark_location(results, 'zip', Location('zip:' + zip_path), Location('zip:' + empty_zip),
+                               sample, repeat)
+
+        if 'ftp' in backends:
+            import rsync_ftp_server
+            ftp_root = os.path.join(work, 'ftp')
+            shutil.copytree(tree, os.path.join(ftp_root, 'tree'))
+            os.makedirs(os.path.join(ftp_root, 'empty'))
+            server = rsync_ftp_server.create_server(ftp_root, 0, hashing=False, latency=latency)
+            rsync_ftp_server.start_in_background(server)
+            try:
+                host = f"user:password@127.0.0.1:{rsync_ftp_server.get_port(server)}"
+                source = Location(f"ftp:{host}/tree/")
+                destination = Location(f"ftp:{host}/empty/")
+                benchmark_location(results, 'ftp', source, destination, sample, repeat)
+            finally:
+                ftp.close_connections()
+                server.close_all()
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {'files': files, 'min_size': min_size, 'max_size': max_size, 'depth': depth,
+                   'repeat': repeat, 'latency': latency, 'sample_size': sample_size, 'seed': seed},
+        'results': results,
+    }
+
+
+def hash_with_small_reads(path: str):
+    """This method hashes the local file at the path given as parameter the way the locations did before rsync_hash,
+    with md5 and 4 KB reads, as the reference of the hashing benchmark"""
+    hash_md5 = hashlib.md5()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(4096), b""):
+            hash_md5.update(chunk)
+    return hash_md5.hexdigest()
+
+
+def benchmark_hashing(files: int, size: int, algorithms, workers: int, repeat: int, seed: int = 0):
+    """This method writes files random files of size bytes and returns a list of [method, MB/s] lists for hashing
+    all of them: with 4 KB md5 reads like before, with rsync_hash for each algorithm given as parameter,
+    and with the process pool of rsync_hash for each algorithm.
+    The files are read once before timing, so every method reads them from the page cache."""
+    work = tempfile.mkdtemp(prefix='rsync_hashing_')
+    try:
+        generator = random.Random(seed)
+        paths = []
+        for index in range(files):
+            paths.append(os.path.join(work, f"f{index}.bin"))
+            with open(paths[-1], 'wb') as file:
+                file.write(generator.randbytes(size))
+        for path in paths:
+            hash_with_small_reads(path)
+
+        megabytes = files * size / 1e6
+        methods = [['md5 4KB reads', lambda: [hash_with_small_reads(path) for path in paths]]]
+        for name in algorithms:
+            methods.append([f"{name} rsync_hash", lambda name=name: [rsync_hash.hash_local_file(path, name)
+                                                                     for path in paths]])
+            methods.append([f"{name} {workers} processes",
+                            lambda name=name: rsync_hash.hash_local_files(paths, name, workers)])
+        results = []
+        for method, function in methods:
+            best = min(time_call(function)[0] for _ in range(repeat))
+            results.append([method, megabytes / best])
+        return results
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def git_commit():
+    """This method returns the current git commit of the project OR None if it is not known"""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    """This method parses the command line arguments and prints the results of the requested benchmark"""
+    parser = argparse.ArgumentParser(description="Advanced RSync benchmarks")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    suite = commands.add_parser('suite', help="benchmark every backend on a synthetic tree")
+    suite.add_argument('--files', type=int, default=1000)
+    suite.add_argument('--min-size', type=int, default=1024)
+    suite.add_argument('--max-size', type=int, default=1024 * 1024)
+    suite.add_argument('--depth', type=int, default=3)
+    suite.add_argument('--repeat', type=int, default=3)
+    suite.add_argument('--backends', default="folder,zip,ftp", help="comma separated backends")
+    suite.add_argument('--latency', type=float, default=0.0, help="seconds added by the ftp server to each command")
+    suite.add_argument('--sample', type=int, default=50, help="files copied and deleted by the copy benchmarks")
+    suite.add_argument('--seed', type=int, default=0)
+    suite.add_argument('--output', help="JSON file where the report is written")
+
+    workers = commands.add_parser('ftp-workers', help="benchmark the parallel ftp hashing for each workers count")
+    workers.add_argument('--ftp', required=True, help="ftp location url: user:password@host/path")
+    workers.add_argument('--workers', default="1,2,4,8,16", help="comma separated workers counts")
+    workers.add_argument('--repeat', type=int, default=3)
+
+    hashing = commands.add_parser('hashing', help="benchmark the hashing of local files in MB/s")
+    hashing.add_argument('--files', type=int, default=8)
+    hashing.add_argument('--size', type=int, default=64 * 1024 * 1024, help="bytes of each file")
+    hashing.add_argument('--algorithms', default="md5,sha1,blake2b", help="comma separated algorithms")
+    hashing.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    hashing.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.command == 'hashing':
+        print(f"{'method':<28} {'MB/s':>10}")
+        for method, speed in benchmark_hashing(args.files, args.size, args.algorithms.split(','), args.workers,
+                                               args.repeat):
+            print(f"{method:<28} {speed:>10.1f}")
+        return
+
+    if args.command == 'suite':
+        report = run_suite(args.files, args.min_size, args.max_size, args.depth, args.repeat,
+                           args.backends.split(','), args.latency, args.sample, args.seed)
+        for result in report['results']:
+            print(f"{result['backend']:>8} {result['operation']:<24} {result['best']:>10.3f}s")
+        if args.output:
+            with open(args.output, 'w') as output:
+                json.dump(report, output, indent=2)
+        return
+
+    workers_counts = [int(value) for value in args.workers.split(',')]
+    print(f"{'workers':>8} {'seconds':>10} {'speedup':>8}")
+    for workers, seconds, speedup in benchmark_ftp_workers(args.ftp, workers_counts, args.repeat):
+        print(f"{workers:>8} {seconds:>10.3f} {speedup:>7.2f}x")
+    ftp.close_connections()
+
+
+if __name__ == '__main__':
+    main()
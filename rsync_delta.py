@@ -0,0 +1,168 @@
+import hashlib
+import math
+import os
+import zlib
+
+_chunk_size: int = 1024 * 1024
+"""the number of bytes read at once from the new file, and the most literal bytes kept before they are sent"""
+
+min_block_size: int = 2048
+
+max_block_size: int = 128 * 1024
+
+max_literal_ratio: float = 0.25
+"""the part of the old copy of a file which can be sent as data by patch_file before it gives up for a whole copy,
+as finding the blocks of a new copy costs much more in Python than copying it when its content differs throughout"""
+
+max_literal_size: int = 4 * 1024 * 1024
+"""the most data bytes patch_file sends before giving up for a whole copy, whatever the size of the file"""
+
+_modulo = 65521
+"""the modulo of the Adler-32 sums, so the rolling checksum is the same as zlib.adler32 of the window"""
+
+
+def choose_block_size(size: int):
+    """This method returns the block size used for a file of size bytes: the square root of its size like rsync,
+    so the signature and the number of blocks both grow slowly, between min_block_size and max_block_size"""
+    return max(min_block_size, min(max_block_size, int(math.sqrt(size)) // 8 * 8))
+
+
+def strong_hash(block: bytes):
+    """This method returns the strong hash checked after the weak checksum of a block matched"""
+    return hashlib.md5(block).digest()
+
+
+def signature(stream, block_size: int):
+    """This method reads the old copy of a file from the binary stream given as parameter and returns a list
+    of [weak checksum, strong hash] lists, one for each block of block_size bytes (the last one can be shorter)"""
+    blocks = []
+    for block in iter(lambda: stream.read(block_size), b""):
+        blocks.append([zlib.adler32(block), strong_hash(block)])
+    return blocks
+
+
+def delta(blocks, stream, block_size: int, with_data: bool = False):
+    """This generator reads the new copy of a file from the binary stream given as parameter and yields the
+    instructions which build it from the old copy whose signature is given in blocks: ['block', index] to copy
+    the block with that index from the old copy and ['data', bytes] for the bytes which are not in the old copy.
+    If with_data is True, the blocks are given as ['block', index, bytes], with their bytes read from the new copy.
+    The window slides one byte at a time while nothing matches, updating the Adler-32 sums in constant time,
+    and jumps a whole block when one matches, so an unchanged file is only hashed once per block."""
+    index = {}
+    for number, (weak, strong) in enumerate(blocks):
+        index.setdefault(weak, {}).setdefault(strong, number)
+
+    buffer = b""
+    position = 0
+    """the first byte of the window in the buffer"""
+    literal = 0
+    """the first byte of the buffer which was not sent yet"""
+    weak = None
+    eof = False
+    while True:
+        if not eof and len(buffer) - position <= block_size:
+            if position - literal > 0:
+                yield ['data', buffer[literal:position]]
+            buffer = buffer[position:]
+            position = literal = 0
+            data = stream.read(max(_chunk_size, block_size))
+            eof = len(data) == 0
+            buffer += data
+            continue
+
+        end = position + block_size
+        if end > len(buffer):
+            # the end of the file is shorter than a block, it can only be the last block of the old copy
+            tail = buffer[position:]
+            number = index.get(zlib.adler32(tail), {}).get(strong_hash(tail)) if tail else None
+            if number is not None:
+                if position > literal:
+                    yield ['data', buffer[literal:position]]
+                yield ['block', number, tail] if with_data else ['block', number]
+            elif len(buffer) > literal:
+                yield ['data', buffer[literal:]]
+            return
+
+        if weak is None:
+            weak = zlib.adler32(buffer[position:end])
+        candidates = index.get(weak)
+        if candidates is not None:
+            number = candidates.get(strong_hash(buffer[position:end]))
+            if number is not None:
+                if position > literal:
+                    yield ['data', buffer[literal:position]]
+                yield ['block', number, buffer[position:end]] if with_data else ['block', number]
+                position = literal = end
+                weak = None
+                continue
+
+        if end < len(buffer):
+            out, new = buffer[position], buffer[end]
+            a = ((weak & 0xffff) - out + new) % _modulo
+            b = ((weak >> 16) - block_size * out + a - 1) % _modulo
+            weak = a | (b << 16)
+        else:
+            weak = None
+        position += 1
+        if position - literal >= _chunk_size:
+            yield ['data', buffer[literal:position]]
+            literal = position
+
+
+def patch(old, instructions, target, block_size: int):
+    """This method writes in the binary target stream the new copy of a file built from the instructions returned
+    by delta, reading the blocks from the seekable old copy given as parameter.
+    It returns a [bytes copied from the old copy, bytes sent as data] list."""
+    matched, sent = 0, 0
+    for kind, value in instructions:
+        if kind == 'block':
+            old.seek(value * block_size)
+            block = old.read(block_size)
+            target.write(block)
+            matched += len(block)
+        else:
+            target.write(value)
+            sent += len(value)
+    return [matched, sent]
+
+
+def patch_file(path: str, stream, block_size: int = None):
+    """This method makes the local file at the path given as parameter the same as the new copy read from the
+    binary stream given as parameter, changing it in place. The blocks which are already at their offset are not
+    written again, the other bytes are written at their offset and the file is truncated to the size of the new copy,
+    so a small change costs a read of the file and the write of the changed blocks instead of a whole copy.
+    A block found at another offset is written from the stream, as it can be overwritten before it is needed.
+    It returns a [bytes kept from the old copy, bytes written, offset of the first changed byte] list,
+    the offset being the size of the new copy if nothing changed, OR None if more than max_literal_ratio of the old
+    copy or max_literal_size bytes were not found in it. The file is then partly patched and must be copied whole."""
+    old_size = os.path.getsize(path)
+    if block_size is None:
+        block_size = choose_block_size(old_size)
+    max_literal = min(max_literal_size, int(max_literal_ratio * old_size))
+    literal = 0
+    with open(path, 'rb') as old:
+        blocks = signature(old, block_size)
+    kept, written = 0, 0
+    offset = 0
+    first_change = None
+    with open(path, 'r+b') as target:
+        for instruction in delta(blocks, stream, block_size, with_data=True):
+            data = instruction[-1]
+            if instruction[0] == 'data':
+                literal += len(data)
+                if literal > max_literal:
+                    return None
+            if instruction[0] == 'block' and instruction[1] * block_size == offset:
+                kept += len(data)
+            else:
+                if first_change is None:
+                    first_change = offset
+                target.seek(offset)
+                target.write(data)
+                written += len(data)
+            offset += len(data)
+        if os.fstat(target.fileno()).st_size != offset:
+            target.truncate(offset)
+            if first_change is None:
+                first_change = offset
+    return [kept, written, offset if first_change is None else first_change]
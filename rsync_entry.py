@@ -0,0 +1,126 @@
+import os
+import time
+from contextlib import contextmanager
+from functools import partial
+import rsync_hash
+import rsync_metrics as metrics
+from rsync_manifest import Manifest
+
+
+class FileEntry:
+    """This class holds what is known about a file or a directory of a location without a list per entry:
+    its relative path (directories end with '/'), if it is a directory, its size and modification time.
+    The hash is computed only when it is asked for the first time, so listing a location reads no file content."""
+    __slots__ = ('path', 'is_dir', 'size', 'mtime', '_hash', '_hasher')
+
+    def __init__(self, path: str, is_dir: bool, size: int, mtime: float, hasher=None, file_hash: str = None):
+        """Constructor that sets the metadata given as parameters.
+        The hasher is a function called without parameters which returns the hash of the file."""
+        self.path = path
+        self.is_dir = is_dir
+        self.size = size
+        self.mtime = mtime
+        self._hash = file_hash
+        self._hasher = hasher
+
+    @property
+    def hash(self):
+        """This method returns the hash of the file, computing it the first time, OR None for a directory"""
+        if self._hash is None and self._hasher is not None:
+            self._hash = self._hasher()
+            self._hasher = None
+        return self._hash
+
+    def to_list(self):
+        """This method returns the [relative path, hash] list of this entry, like the ones of get_files_with_hash"""
+        return [self.path, "directory" if self.is_dir else self.hash]
+
+    def __repr__(self):
+        return f"FileEntry({self.path!r}, is_dir={self.is_dir}, size={self.size}, mtime={self.mtime})"
+
+
+def sort_key(path: str):
+    """This method returns the key the entries are sorted by: the list of the path components.
+    It is the order of a top down walk listing each directory sorted by name, where a directory
+    is followed by everything inside it, so a location can be listed in this order without sorting it all."""
+    return path.rstrip('/').split('/')
+
+
+def diff(source, destination):
+    """This generator compares two iterables of FileEntry objects sorted by sort_key and yields
+    the [relative path, change] lists of the paths which are 'added' to, 'deleted' from or 'changed' in the source
+    compared with the destination. Only one entry of each side is kept in memory and the hashes are computed
+    only for the files with the same path and size, so files of different sizes are never read.
+    Unlike merkle.diff, the paths inside added or deleted directories are reported too."""
+    source, destination = iter(source), iter(destination)
+    left, right = next(source, None), next(destination, None)
+    while left is not None or right is not None:
+        if right is None or (left is not None and sort_key(left.path) < sort_key(right.path)):
+            yield [left.path, 'added']
+            left = next(source, None)
+        elif left is None or sort_key(right.path) < sort_key(left.path):
+            yield [right.path, 'deleted']
+            right = next(destination, None)
+        else:
+            if left.is_dir != right.is_dir:
+                yield [right.path, 'deleted']
+                yield [left.path, 'added']
+            elif not left.is_dir and (left.size != right.size or left.hash != right.hash):
+                yield [left.path, 'changed']
+            left, right = next(source, None), next(destination, None)
+
+
+def hash_folder_file(local_path: str, relative_path: str, size: int, mtime: float, manifest: Manifest = None):
+    """This method returns the hash of the local file at the path given as parameter.
+    If a manifest is given, the file is read only if its size or modification time changed since it was hashed."""
+    if manifest is not None:
+        file_hash = manifest.get_hash(relative_path, size, mtime)
+        if file_hash is not None:
+            return file_hash
+    started = time.time()
+    file_hash = rsync_hash.hash_local_file(local_path)
+    metrics.add_bytes('folder', read=size)
+    if manifest is not None:
+        manifest.set_hash(relative_path, size, mtime, file_hash, started)
+    return file_hash
+
+
+@contextmanager
+def open_folder_file(path: str, file: str):
+    """This method is used in a with statement to read the file given as parameter from the folder at the path given
+    as parameter. It gives a (readable binary stream, file size) tuple, like the open_file of the other locations."""
+    local_path = os.path.join(path, file)
+    with open(local_path, 'rb') as stream:
+        size = os.fstat(stream.fileno()).st_size
+        yield stream, size
+    metrics.add_bytes('folder', read=size)
+
+
+def write_folder_file(path: str, file: str, stream, size: int = None):
+    """This method writes the file given as parameter in the folder at the path given as parameter with the content
+    read from the binary stream given as parameter in chunks of rsync_hash.buffer_size bytes, creating its directories.
+    The size parameter is not needed by the folders, it is there to match the other locations."""
+    local_path = os.path.join(path, file)
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    written = 0
+    with open(local_path, 'wb') as target:
+        for chunk in iter(lambda: stream.read(rsync_hash.buffer_size), b""):
+            target.write(chunk)
+            written += len(chunk)
+    metrics.add_bytes('folder', written=written)
+
+
+def iter_folder(path: str, manifest: Manifest = None, prefix: str = ''):
+    """This generator yields a FileEntry for every file and directory inside the folder at the path given as parameter
+    in sort_key order. Only the listing of the directories being walked is kept in memory."""
+    with os.scandir(os.path.join(path, prefix) if prefix else path) as entries:
+        listing = sorted((entry.name, entry.is_dir(), entry.stat()) for entry in entries)
+    for name, is_dir, stat in listing:
+        relative_path = prefix + name
+        if is_dir:
+            yield FileEntry(relative_path + '/', True, 0, stat.st_mtime)
+            yield from iter_folder(path, manifest, relative_path + '/')
+        else:
+            yield FileEntry(relative_path, False, stat.st_size, stat.st_mtime,
+                            partial(hash_folder_file, os.path.join(path, relative_path), relative_path,
+                                    stat.st_size, stat.st_mtime, manifest))
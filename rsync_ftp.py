@@ -1,12 +1,65 @@
+import atexit
+import ftplib
 import hashlib
 import os
+import posixpath
+import re
+import shutil
+import socket
+import stat
+import threading
 import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from functools import partial
 import ftputil
+import ftputil.error
+import ftputil.session
+import rsync_hash
+import rsync_metrics as metrics
+from rsync_entry import FileEntry
+from rsync_manifest import Manifest, metadata_signature
 
 storage_path: str = "E:\\Info\\FACULTATE\\ANUL_3\\PYTHON\\PROIECT\\Advanced RSync\\storage"
 
-_temp_path: str = "E:\\Info\\FACULTATE\\ANUL_3\\PYTHON\\PROIECT\\Advanced RSync\\_temp\\_temp.tmp"
-"""this file is used to copy from the ftp server to it when trying to read bytes or other functionalities"""
+_chunk_size: int = 1024 * 1024
+"""the number of bytes read at once from the ftp server when hashing a file"""
+
+mtime_precision: float = 60.0
+"""the seconds the modification time of a listed file can be off by, the LIST replies only having the minutes
+(and only the day for the files older than six months)"""
+
+retries: int = 5
+"""how many times a dropped transfer is resumed before giving up"""
+
+retry_delay: float = 1.0
+"""the seconds waited before the first retry, doubled after each failed retry"""
+
+_retried_errors = (ftputil.error.TemporaryError, ftputil.error.FTPOSError, ftplib.error_temp, ConnectionError,
+                   socket.timeout, EOFError)
+"""the errors of a transfer which are retried: ftputil wraps the socket errors of the server in FTPOSError"""
+
+verify_hash: bool = False
+"""if True, every transfer is also checked by comparing the hashes of the local and remote files.
+A transfer resumed from an existing '.part' file is always checked, as that file can be left from another version."""
+
+server_hashing: bool = True
+"""if True, the files are hashed by the ftp server when it supports it, instead of being downloaded"""
+
+_hash_commands = [
+    # (hashlib algorithm, HASH algorithm name, X command, hex digits of the digest)
+    ('md5', 'MD5', 'XMD5', 32),
+    ('sha1', 'SHA-1', 'XSHA1', 40),
+    ('sha256', 'SHA-256', 'XSHA256', 64),
+    ('crc32', 'CRC32', 'XCRC', 8),
+]
+"""the hashing commands which can be sent to a server, in the order they are preferred"""
+
+_capabilities = {}
+"""maps a (hostname, port) tuple to the set of hashing commands its server announced in the FEAT response"""
+
+_capabilities_lock = threading.Lock()
 
 
 def extract_path(URL: str):
@@ -29,74 +82,428 @@ def get_connection(URL: str):
     OR None if that location is invalid"""
     hostname, username, password = extract_connection_information(URL)
     try:
+        if ':' in hostname:
+            # a hostname like 127.0.0.1:2121 is used for servers which are not on the default port
+            hostname, port = hostname.rsplit(':', 1)
+            session_factory = ftputil.session.session_factory(port=int(port))
+            return ftputil.FTPHost(hostname, username, password, session_factory=session_factory)
         ftp = ftputil.FTPHost(hostname, username, password)
         return ftp
     except BaseException:
         return None
 
 
+class ConnectionPool:
+    """This class keeps opened FTPHost connections so they can be reused between operations.
+    Connections are grouped by hostname and username, at most max_size connections are opened for each group,
+    idle connections are closed after idle_timeout seconds and every connection is checked before being reused.
+    The stat cache of a connection is cleared when it is given back and when it is reused, so an operation
+    never sees the sizes, modification times or files remembered by a previous one."""
+
+    def __init__(self, max_size: int = 4, idle_timeout: float = 60.0, recheck_after: float = 5.0):
+        """Constructor that sets the pool limits given as parameters.
+        A connection given back less than recheck_after seconds ago is reused without being checked."""
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.recheck_after = recheck_after
+        self._condition = threading.Condition()
+        self._idle = {}
+        """maps a (hostname, username) key to a list of [FTPHost, last time it was released] lists"""
+        self._opened = {}
+        """maps a (hostname, username) key to the number of connections opened for it (idle or in use)"""
+        self._generation = 0
+        """incremented by close_all, the connections taken before are closed when they are given back"""
+        self._borrowed = {}
+        """maps an in use FTPHost to the generation of the pool it was taken in"""
+
+    @staticmethod
+    def _key(URL: str):
+        """This method returns the key used to group the connections for the ftp url given as parameter"""
+        hostname, username, password = extract_connection_information(URL)
+        return hostname, username
+
+    @staticmethod
+    def _is_alive(host):
+        """This method checks if the FTPHost given as parameter can still talk with the server"""
+        try:
+            host.keep_alive()
+            return True
+        except BaseException:
+            return False
+
+    @staticmethod
+    def _close(host):
+        """This method closes the FTPHost given as parameter ignoring the errors of an already dropped connection"""
+        try:
+            host.close()
+        except BaseException:
+            pass
+
+    def _take_expired(self):
+        """This method removes from the pool the connections which were not used for more than idle_timeout seconds
+        and returns them, so they are closed after the lock is released. It must be called while holding the lock."""
+        now = time.monotonic()
+        expired = []
+        for key in list(self._idle):
+            for entry in [entry for entry in self._idle[key] if now - entry[1] > self.idle_timeout]:
+                self._idle[key].remove(entry)
+                self._opened[key] -= 1
+                expired.append(entry[0])
+                self._condition.notify()
+        return expired
+
+    def _discard(self, key, host):
+        """This method closes the broken FTPHost given as parameter and frees its place in the pool"""
+        with self._condition:
+            self._borrowed.pop(host, None)
+            self._opened[key] -= 1
+            self._condition.notify()
+        self._close(host)
+
+    def acquire(self, URL: str):
+        """This method returns a FTPHost connection for the ftp url given as parameter, reusing an idle one if possible,
+        OR None if a new connection can not be opened. It waits if max_size connections are already in use.
+        The lock is only held to take a connection, it is checked and the expired ones are closed after,
+        so the other threads do not wait for those network round trips."""
+        key = self._key(URL)
+        while True:
+            entry = None
+            opening = False
+            with self._condition:
+                expired = self._take_expired()
+                idle = self._idle.get(key)
+                if idle:
+                    entry = idle.pop()
+                    self._borrowed[entry[0]] = self._generation
+                elif self._opened.get(key, 0) < self.max_size:
+                    self._opened[key] = self._opened.get(key, 0) + 1
+                    generation = self._generation
+                    opening = True
+                elif not expired:
+                    self._condition.wait()
+                    continue
+            for host in expired:
+                self._close(host)
+            if opening:
+                break
+            if entry is None:
+                continue
+            host, released = entry
+            if time.monotonic() - released < self.recheck_after or self._is_alive(host):
+                # the stat cache of ftputil never expires, the files may have changed since it was filled
+                host.stat_cache.clear()
+                return host
+            self._discard(key, host)
+
+        host = get_connection(URL)
+        metrics.count('ftp', 'connections')
+        with self._condition:
+            if host is None:
+                self._opened[key] -= 1
+                self._condition.notify()
+            else:
+                self._borrowed[host] = generation
+        return host
+
+    def release(self, URL: str, host):
+        """This method gives back to the pool the FTPHost given as parameter.
+        If the pool was shut down since it was taken, the connection is closed instead of being kept."""
+        key = self._key(URL)
+        host.stat_cache.clear()
+        closing = []
+        with self._condition:
+            if self._borrowed.pop(host, self._generation) != self._generation:
+                self._opened[key] -= 1
+                closing.append(host)
+            else:
+                self._idle.setdefault(key, []).append([host, time.monotonic()])
+            closing.extend(self._take_expired())
+            self._condition.notify()
+        for host in closing:
+            self._close(host)
+
+    def close_all(self):
+        """This method closes every idle connection and makes the pool close the in use ones when they are released.
+        The pool can still be used after, new connections are opened for the next operations."""
+        closing = []
+        with self._condition:
+            self._generation += 1
+            for key, idle in self._idle.items():
+                for entry in idle:
+                    self._opened[key] -= 1
+                    closing.append(entry[0])
+            self._idle.clear()
+            self._condition.notify_all()
+        for host in closing:
+            self._close(host)
+
+
+_pool = ConnectionPool()
+"""this pool is shared by all the ftp operations"""
+
+
+@contextmanager
+def connection(URL: str):
+    """This method is used in a with statement to borrow a pooled FTPHost connection for the ftp url given as parameter
+    OR None if that location is invalid. The connection is given back to the pool at the end of the block
+    and it is checked again before being reused, so a connection broken inside the block is never handed out."""
+    server = _pool.acquire(URL)
+    try:
+        yield server
+    finally:
+        if server is not None:
+            _pool.release(URL, server)
+
+
+def configure_pool(max_size: int = None, idle_timeout: float = None):
+    """This method changes the limits of the shared connection pool.
+    The parallel operations open up to one connection per worker, so max_size should be at least the workers count."""
+    with _pool._condition:
+        if max_size is not None:
+            _pool.max_size = max_size
+        if idle_timeout is not None:
+            _pool.idle_timeout = idle_timeout
+        _pool._condition.notify_all()
+
+
+def close_connections():
+    """This method closes all the pooled ftp connections. It must be called when the synchronisation ends,
+    the next ftp operations open new connections."""
+    _pool.close_all()
+
+
+atexit.register(close_connections)
+
+
 def ftp_exists(URL: str):
     """This method returns a boolean checking if the ftp location url
     given as parameter from the command line is valid."""
-    con = get_connection(URL)
-    if con is None:
-        return False
-    else:
-        con.close()
-        return True
+    with connection(URL) as con:
+        return con is not None
 
 
 def md5(file_path, hash_md5, a_host):
     """This method receives a relative path in file_path from the ftp server,the FTPHost parameter given at a_host
-       and updates the hash_md5 parameter by downloading the file and reading chunks of 4096 bytes."""
-    f = open(_temp_path, "w+")
-    f.truncate()
-    f.close()
-    a_host.download(file_path, _temp_path)
-    with open(_temp_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    f = open(_temp_path, "w+")
-    f.truncate()
-    f.close()
-
-
-def get_hash(ftp_url: str):
+       and updates the hash_md5 parameter, which can be any hashlib object, by streaming the file from the server.
+       Nothing is written on the disk, so it can be called from many threads as long as each one has its own FTPHost."""
+    with a_host.open(file_path, 'rb') as f:
+        rsync_hash.update_from_stream(hash_md5, f, lambda size: metrics.add_bytes('ftp', read=size))
+
+
+def parse_features(lines):
+    """This method returns the set of hashing commands announced by the feature lines of a FEAT response given as
+    parameter (without its first and last lines), like 'XMD5' or 'HASH MD5'"""
+    features = set()
+    for line in lines:
+        words = line.strip().split(' ', 1)
+        name = words[0].upper()
+        if name == 'HASH' and len(words) > 1:
+            for algorithm in words[1].split(';'):
+                features.add('HASH ' + algorithm.strip().rstrip('*').upper())
+        elif name in [command for algorithm, hash_name, command, digits in _hash_commands]:
+            features.add(name)
+    return features
+
+
+def hash_requests(features, remote_path: str, algorithms=None):
+    """This method returns a list of (algorithm, commands, hex digits of the digest) tuples in the order they are
+    preferred, one for each algorithm from the algorithms parameter (all of them by default) supported by a server
+    with the features given as parameter. The last of the commands answers with the digest of the file at remote_path.
+    It is shared by the ftp backends, which only differ by how they send the commands."""
+    requests = []
+    for algorithm, hash_name, command, digits in _hash_commands:
+        if algorithms is not None and algorithm not in algorithms:
+            continue
+        if 'HASH ' + hash_name in features:
+            requests.append((algorithm, ['OPTS HASH ' + hash_name, 'HASH ' + remote_path], digits))
+        elif command in features:
+            requests.append((algorithm, [command + ' ' + remote_path], digits))
+    return requests
+
+
+def parse_digest(response: str, digits: int, hash_reply: bool = False):
+    """This method returns the lowercase hex digest of digits characters found in the response of a hashing command,
+    without its status code, OR None if there is none. A reply to the HASH command (hash_reply) is parsed by its
+    fields, like 'CRC32 0-12345678 1a2b3c4d file name', as its range could also look like a digest. The replies to
+    the X* commands have no such format, so the digest is searched in them."""
+    if hash_reply:
+        fields = response.split(None, 3)
+        if len(fields) < 3 or not re.fullmatch(r'\d+-\d*', fields[1]):
+            return None
+        digest = fields[2]
+        return digest.lower() if re.fullmatch(r'[0-9a-fA-F]{%d}' % digits, digest) else None
+    match = re.search(r'\b[0-9a-fA-F]{%d}\b' % digits, response)
+    return match.group(0).lower() if match is not None else None
+
+
+def server_capabilities(server):
+    """This method returns the set of hashing commands supported by the server of the FTPHost given as parameter,
+    like 'XMD5' or 'HASH MD5'. The FEAT command is sent only once for each host, the result being cached."""
+    host = (server._session.host, server._session.port)
+    with _capabilities_lock:
+        if host in _capabilities:
+            return _capabilities[host]
+    try:
+        response = server._session.sendcmd('FEAT')
+    except ftplib.all_errors:
+        response = ''
+    features = parse_features(response.splitlines()[1:-1])
+    with _capabilities_lock:
+        _capabilities[host] = features
+    return features
+
+
+def server_digest(server, remote_path: str, algorithms=None):
+    """This method asks the server of the FTPHost given as parameter to hash the file at remote_path
+    and returns an (algorithm, hex digest) tuple, using the first algorithm from the algorithms parameter
+    (all of them by default) that the server supports, OR None if it supports none of them."""
+    if not server_hashing:
+        return None
+    for algorithm, commands, digits in hash_requests(server_capabilities(server), remote_path, algorithms):
+        try:
+            for command in commands:
+                response = server._session.sendcmd(command)
+        except ftplib.all_errors:
+            continue
+        digest = parse_digest(response[4:], digits, commands[-1].startswith('HASH '))
+        if digest is not None:
+            return algorithm, digest
+    return None
+
+
+def local_digest(local_path: str, algorithm: str):
+    """This method returns the hex digest of the local file at the path given as parameter
+    for the algorithm given as parameter, which is a hashlib algorithm name or 'crc32'."""
+    with open(local_path, 'rb') as f:
+        if algorithm == 'crc32':
+            crc = 0
+            for chunk in iter(lambda: f.read(_chunk_size), b""):
+                crc = zlib.crc32(chunk, crc)
+            return '%08x' % crc
+    return rsync_hash.local_hexdigest(local_path, algorithm)
+
+
+def get_hash(ftp_url: str, manifest: Manifest = None):
     """This method returns the md5 hash for the ftp server at the url given as parameter.
     The hash is created from the relative path of the files sorted and then,
-    for each file in sorted order, hashing chunks of 4096 bytes."""
+    for each file in sorted order, hashing its content.
+    If a manifest is given and no file changed its size or modification time, the remembered hash is returned."""
     hash_md5 = hashlib.md5()
 
-    server = get_connection(ftp_url)
-    path = extract_path(ftp_url)
-
-    files_paths = []
-    for root, dirs, files in server.walk(path):
-        if root == '/':
-            root = ''
-        for file in files:
-            files_paths.append(root + '/' + file)
-
-    files_list = get_files_list(ftp_url)
-    files_list.sort()
-    for file in files_list:
-        hash_md5.update(file.encode('UTF-8'))
-
-    files_paths.sort()
-    for file in files_paths:
-        md5(file, hash_md5, server)
-
+    with connection(ftp_url) as server:
+        path = extract_path(ftp_url)
+
+        # the tree is walked only once, the paths list and the files list are both built from it
+        walk = list(server.walk(path))
+        files_paths = []
+        files_metadata = []
+        for root, dirs, files in walk:
+            for file in files:
+                if manifest is not None:
+                    stat_path = posixpath.join(root, file)
+                    files_metadata.append([stat_path, server.path.getsize(stat_path), server.path.getmtime(stat_path)])
+                files_paths.append(('' if root == '/' else root) + '/' + file)
+
+        if manifest is not None:
+            signature = metadata_signature(files_metadata)
+            newest = max((metadata[2] for metadata in files_metadata), default=None)
+            tree_hash = manifest.get_tree_hash(signature)
+            if tree_hash is not None:
+                return tree_hash
+
+        files_list = files_list_from_walk(walk, path)
+        files_list.sort()
+        for file in files_list:
+            hash_md5.update(file.encode('UTF-8'))
+
+        files_paths.sort()
+        for file in files_paths:
+            md5(file, hash_md5, server)
+
+    if manifest is not None:
+        manifest.set_tree_hash(signature, hash_md5.hexdigest(), newest)
     return hash_md5.hexdigest()
 
 
-def get_files_list(ftp_url):
-    """This method returns a list with all the files relative path of the the ftp server at the url given as parameter
-    The paths returned have a specific syntax in order to be correlate with other locations structures."""
-    server = get_connection(ftp_url)
+def hash_file(server, root: str, file: str, relative_path: str, manifest: Manifest = None, size: int = None,
+              mtime: float = None):
+    """This method returns the md5 hash of the file given as parameter from the root directory of the ftp server
+    using the FTPHost connection given as parameter.
+    The hash is computed by the server if it supports it, otherwise the file is streamed from the server.
+    If a manifest is given, the file is read only if its size or modification time changed since it was hashed.
+    They are asked to the server only if they are not given as parameters."""
+    remote_path = posixpath.join(root, file)
+    if manifest is not None:
+        if size is None or mtime is None:
+            size, mtime = server.path.getsize(remote_path), server.path.getmtime(remote_path)
+        file_hash = manifest.get_hash(relative_path, size, mtime)
+        if file_hash is not None:
+            return file_hash
+
+    digest = server_digest(server, remote_path, [rsync_hash.algorithm])
+    if digest is not None:
+        file_hash = rsync_hash.label(digest[1])
+    else:
+        file_digest = rsync_hash.new()
+        md5(remote_path, file_digest, server)
+        file_hash = rsync_hash.label(file_digest.hexdigest())
+    if manifest is not None:
+        manifest.set_hash(relative_path, size, mtime, file_hash)
+    return file_hash
+
+
+def hash_entry(ftp_url: str, root: str, file: str, relative_path: str, manifest: Manifest = None, size: int = None,
+               mtime: float = None):
+    """This method returns the hash_file result for the file of size bytes and mtime given as parameters,
+    taken from its listing. A hash remembered by the manifest is returned without borrowing a pooled connection."""
+    if manifest is not None and size is not None and mtime is not None:
+        file_hash = manifest.get_hash(relative_path, size, mtime)
+        if file_hash is not None:
+            return file_hash
+    with connection(ftp_url) as server:
+        return hash_file(server, root, file, relative_path, manifest, size, mtime)
+
+
+def iter_entries(ftp_url: str, manifest: Manifest = None, top: str = None):
+    """This generator yields a FileEntry for every file and directory from the ftp server at the url given as parameter
+    in sort_key order, with the hash computed only when it is asked for.
+    Each directory is listed with a pooled connection given back before its entries are yielded,
+    so only the listings of the directories being walked are kept in memory."""
     path = extract_path(ftp_url)
+    if top is None:
+        top = path
+    listing = []
+    with connection(ftp_url) as server:
+        for name in server.listdir(top):
+            remote_path = posixpath.join(top, name)
+            is_dir = server.path.isdir(remote_path)
+            size = 0 if is_dir else server.path.getsize(remote_path)
+            listing.append((name, is_dir, size, server.path.getmtime(remote_path)))
+    listing.sort()
+
+    prefix = top.removeprefix(path).replace('\\', '/')
+    for name, is_dir, size, mtime in listing:
+        relative_path = prefix + '/' + name if len(prefix) > 0 else name
+        if is_dir:
+            yield FileEntry(relative_path + '/', True, 0, mtime)
+            yield from iter_entries(ftp_url, manifest, posixpath.join(top, name))
+        else:
+            yield FileEntry(relative_path, False, size, mtime,
+                            partial(hash_entry, ftp_url, top, name, relative_path, manifest, size, mtime))
+
+
+def list_files(server, path: str):
+    """This method returns a list with all the files relative path from the path given as parameter
+    using the FTPHost connection given as parameter."""
+    return files_list_from_walk(server.walk(path), path)
+
+
+def files_list_from_walk(walk, path: str):
+    """This method returns a list with all the files relative path from the path given as parameter
+    built from the (root, dirs, files) tuples given at walk parameter, in the order they are given."""
     files_list = []
 
-    for root, dirs, files in server.walk(path):
+    for root, dirs, files in walk:
         prefix: str = root.removeprefix(path)
         prefix = prefix.replace('\\', '/')
         for file in files:
@@ -112,72 +519,338 @@ def get_files_list(ftp_url):
     return files_list
 
 
+def parallel_walk(ftp_url: str, path: str, workers: int):
+    """This method returns a list of (root, dirs, files) tuples in the same order as FTPHost.walk for the path given
+    as parameter, but each directory is listed by a thread pool of workers size, every worker using its own
+    pooled connection to the ftp server at the url given as parameter."""
+
+    def list_directory(top):
+        with connection(ftp_url) as server:
+            dirs, files = [], []
+            for name in server.listdir(top):
+                if server.path.isdir(posixpath.join(top, name)):
+                    dirs.append(name)
+                else:
+                    files.append(name)
+            return top, dirs, files
+
+    listings = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(list_directory, path)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                top, dirs, files = future.result()
+                listings[top] = (dirs, files)
+                for directory in dirs:
+                    pending.add(executor.submit(list_directory, posixpath.join(top, directory)))
+
+    # rebuild the top down order of FTPHost.walk from the listings which finished in any order
+    walk = []
+    stack = [path]
+    while stack:
+        top = stack.pop()
+        dirs, files = listings[top]
+        walk.append((top, dirs, files))
+        stack.extend(posixpath.join(top, directory) for directory in reversed(dirs))
+    return walk
+
+
+def get_files_list(ftp_url, workers: int = 1):
+    """This method returns a list with all the files relative path of the the ftp server at the url given as parameter
+    The paths returned have a specific syntax in order to be correlate with other locations structures.
+    If workers is greater than 1, the directories are listed in parallel over that many connections."""
+    path = extract_path(ftp_url)
+    if workers > 1:
+        return files_list_from_walk(parallel_walk(ftp_url, path, workers), path)
+    with connection(ftp_url) as server:
+        return list_files(server, path)
+
+
 def get_last_modification_date_of_file(ftp_url: str, filePath: str):
     """This method returns the last modification date of the file given as parameter of the ftp server at the url
     It has a specific format in order to be correlate with other locations structures."""
-    server = get_connection(ftp_url)
-    # Get file's Last modification time stamp only in terms of seconds since epoch
-    modTimesinceEpoc = server.path.getmtime(filePath)
+    with connection(ftp_url) as server:
+        # Get file's Last modification time stamp only in terms of seconds since epoch
+        modTimesinceEpoc = server.path.getmtime(filePath)
     # Convert seconds since epoch to readable timestamp
     return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(modTimesinceEpoc))
 
 
-def get_files_with_hash(ftp_url):
+def stat_snapshot(ftp_url: str):
+    """This method returns a dictionary mapping every file and directory relative path of the ftp server at the url
+    given as parameter (with the same syntax as get files list) to a [size, modification time in seconds since epoch,
+    'file' or 'directory'] list. Each directory is listed once and the metadata is parsed from that listing,
+    so there is no round trip per file."""
+    path = extract_path(ftp_url)
+    snapshot = {}
+    with connection(ftp_url) as server:
+        for root, dirs, files in server.walk(path):
+            prefix: str = root.removeprefix(path)
+            prefix = prefix.replace('\\', '/')
+            for name in files + dirs:
+                # served from the stat cache filled by listing root
+                result = server.lstat(posixpath.join(root, name))
+                relative_path = prefix + '/' + name if len(prefix) > 0 else name
+                if stat.S_ISDIR(result.st_mode):
+                    snapshot[relative_path + '/'] = [0, result.st_mtime, 'directory']
+                else:
+                    snapshot[relative_path] = [result.st_size, result.st_mtime, 'file']
+    return snapshot
+
+
+def get_files_with_hash(ftp_url, workers: int = 1, manifest: Manifest = None):
     """This method returns a list of lists where
     the first element in each list is a file relative path from the server path( similar to get files list)
-    and the second element is that file's hash."""
-    server = get_connection(ftp_url)
+    and the second element is that file's hash.
+    If workers is greater than 1, the tree is listed and the files are hashed in parallel over that many connections,
+    the result being the same as the serial one.
+    If a manifest is given, only the files whose size or modification time changed are read."""
+    if workers > 1:
+        files_list = parallel_files_with_hash(ftp_url, workers, manifest)
+    else:
+        path = extract_path(ftp_url)
+        files_list = []
+        with connection(ftp_url) as server:
+            for root, dirs, files in server.walk(path):
+                prefix: str = root.removeprefix(path)
+                prefix = prefix.replace('\\', '/')
+                for file in files:
+                    if len(prefix) > 0:
+                        relative_path = prefix + '/' + file
+                    else:
+                        relative_path = file
+                    files_list.append([relative_path, hash_file(server, root, file, relative_path, manifest)])
+                for directory in dirs:
+                    if len(prefix) > 0:
+                        files_list.append(
+                            [prefix + '/' + directory + '/', "directory"])
+                    else:
+                        files_list.append([directory + '/', "directory"])
+
+    if manifest is not None:
+        manifest.forget_unseen()
+    return files_list
+
+
+def parallel_files_with_hash(ftp_url, workers: int, manifest: Manifest = None):
+    """This method returns the same list as get_files_with_hash for the ftp server at the url given as parameter,
+    listing the directories with parallel_walk and hashing the files with a thread pool of workers size."""
     path = extract_path(ftp_url)
     files_list = []
-    for root, dirs, files in server.walk(path):
+    files_to_hash = []
+    for root, dirs, files in parallel_walk(ftp_url, path, workers):
         prefix: str = root.removeprefix(path)
         prefix = prefix.replace('\\', '/')
-        if root == '/':
-            root = ''
         for file in files:
-            hash_md5 = hashlib.md5()
-            md5(root + '\\' + file, hash_md5, server)
-            file_hash = hash_md5.hexdigest()
             if len(prefix) > 0:
-                files_list.append([prefix + '/' + file, file_hash])
+                files_list.append([prefix + '/' + file, None])
             else:
-                files_list.append([file, file_hash])
+                files_list.append([file, None])
+            files_to_hash.append([files_list[-1], root, file])
         for directory in dirs:
             if len(prefix) > 0:
-                files_list.append(
-                    [prefix + '/' + directory + '/', "directory"])
+                files_list.append([prefix + '/' + directory + '/', "directory"])
             else:
                 files_list.append([directory + '/', "directory"])
+
+    def hash_entry(entry_to_hash):
+        entry, root, file = entry_to_hash
+        with connection(ftp_url) as server:
+            entry[1] = hash_file(server, root, file, entry[0], manifest)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(hash_entry, files_to_hash))
     return files_list
 
 
-def copy_to_storage(ftp_url: str, file: str):
+def with_retries(transfer, *args):
+    """This method calls the transfer function given as parameter with the args given as parameter,
+    calling it again after a growing delay if the connection fails, at most retries times.
+    Only the temporary replies of the server and the dropped or timed out connections are retried, the permanent
+    errors, like a missing remote file, and the errors of the local files are raised at once."""
+    for attempt in range(retries + 1):
+        try:
+            return transfer(*args)
+        except _retried_errors:
+            if attempt == retries:
+                raise
+            metrics.count('ftp', 'retries')
+            time.sleep(retry_delay * 2 ** attempt)
+
+
+def same_content(server, remote_path: str, local_path: str):
+    """This method checks if the remote file at remote_path has the same content as the local file at local_path,
+    comparing a hash computed by the server if it supports it, or else the md5 hash of the streamed remote file."""
+    digest = server_digest(server, remote_path)
+    if digest is not None:
+        algorithm, remote_hash = digest
+        return remote_hash == local_digest(local_path, algorithm)
+    hash_md5 = hashlib.md5()
+    md5(remote_path, hash_md5, server)
+    return hash_md5.hexdigest() == local_digest(local_path, 'md5')
+
+
+def resumable_download(ftp_url: str, remote_path: str, local_path: str, wrap=None):
+    """This method downloads the file at remote_path from the ftp server at the url given as parameter to local_path.
+    The bytes are first written to local_path + '.part' and, if the connection drops, the download is resumed
+    from the end of that file with a REST offset instead of starting again from the first byte.
+    The file is moved to local_path only after its size matched the remote one, and its hash too if it was resumed
+    or verify_hash is set, so a stale '.part' file of the same size is downloaded again instead of being kept.
+    The wrap parameter is a function which receives the stream read from the server and returns the one copied."""
+    part_path = local_path + '.part'
+
+    def download():
+        with connection(ftp_url) as server:
+            size = server.path.getsize(remote_path)
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            if offset > size:
+                offset = 0
+            if offset < size or not os.path.exists(part_path):
+                with server.open(remote_path, 'rb', rest=offset) as source, \
+                        open(part_path, 'r+b' if offset else 'wb') as target:
+                    target.seek(offset)
+                    target.truncate()
+                    shutil.copyfileobj(source if wrap is None else wrap(source), target, _chunk_size)
+                metrics.add_bytes('ftp', read=size - offset)
+            if os.path.getsize(part_path) != size:
+                raise EOFError(f"Incomplete download of {remote_path}")
+            if (verify_hash or offset > 0) and not same_content(server, remote_path, part_path):
+                os.remove(part_path)
+                raise EOFError(f"Corrupted download of {remote_path}")
+        os.replace(part_path, local_path)
+
+    with_retries(download)
+
+
+def resumable_upload(ftp_url: str, local_path: str, remote_path: str, wrap=None):
+    """This method uploads the local file at local_path to remote_path on the ftp server at the url given as parameter.
+    The bytes are first written to remote_path + '.part' and, if the connection drops, the upload is resumed
+    with a REST offset from the size the partial remote file reached.
+    The file is renamed to remote_path only after its size matched the local one, and its hash too if it was resumed
+    or verify_hash is set, so a stale '.part' file of the same size is uploaded again instead of being kept.
+    The wrap parameter is a function which receives the stream read from the local file and returns the one copied."""
+    part_path = remote_path + '.part'
+
+    def upload():
+        size = os.path.getsize(local_path)
+        with connection(ftp_url) as server:
+            server.stat_cache.invalidate(part_path)
+            offset = server.path.getsize(part_path) if server.path.isfile(part_path) else 0
+            if offset > size:
+                offset = 0
+            if offset < size or not server.path.isfile(part_path):
+                with open(local_path, 'rb') as source, server.open(part_path, 'wb', rest=offset) as target:
+                    source.seek(offset)
+                    shutil.copyfileobj(source if wrap is None else wrap(source), target, _chunk_size)
+                metrics.add_bytes('ftp', written=size - offset)
+            server.stat_cache.invalidate(part_path)
+            if server.path.getsize(part_path) != size:
+                raise EOFError(f"Incomplete upload of {remote_path}")
+            if (verify_hash or offset > 0) and not same_content(server, part_path, local_path):
+                server.remove(part_path)
+                raise EOFError(f"Corrupted upload of {remote_path}")
+            if server.path.exists(remote_path):
+                server.remove(remote_path)
+            server.rename(part_path, remote_path)
+
+    with_retries(upload)
+
+
+def same_remote_copy(ftp_url: str, remote_path: str, local_path: str, manifest: Manifest = None,
+                     relative_path: str = None):
+    """This method checks if the file at remote_path on the ftp server at the url given as parameter has the same
+    content as the local file at local_path, without downloading it: its hash is computed by the server if it
+    supports it, or else taken from the manifest given as parameter, under relative_path, if the remote file did not
+    change since it was hashed. It returns False when the remote file is missing or its hash is not known."""
+    with connection(ftp_url) as server:
+        if not server.path.isfile(remote_path):
+            return False
+        digest = server_digest(server, remote_path)
+        if digest is not None:
+            return digest[1] == local_digest(local_path, digest[0])
+        if manifest is None:
+            return False
+        file_hash = manifest.get_hash(relative_path, server.path.getsize(remote_path),
+                                      server.path.getmtime(remote_path))
+    return file_hash is not None and file_hash == rsync_hash.hash_local_file(local_path)
+
+
+def patch_upload(ftp_url: str, local_path: str, remote_path: str, offset: int):
+    """This method makes the file at remote_path on the ftp server at the url given as parameter the same as the local
+    file at local_path, sending only its bytes from offset, when the remote file is the same as the local one before
+    offset, like an old copy checked with same_remote_copy and then changed by rsync_delta.patch_file.
+    The remote file is renamed to remote_path + '.part', written from offset with a REST offset and renamed back
+    only after its size, and its hash if the server can compute it or verify_hash is set, matched the local file.
+    A ftp server can only overwrite a file from an offset, so if the local file is shorter than the remote one
+    or the patched file is not the same as the local one, the whole file is uploaded with resumable_upload."""
+    part_path = remote_path + '.part'
+    size = os.path.getsize(local_path)
+    with connection(ftp_url) as server:
+        remote_size = server.path.getsize(remote_path) if server.path.isfile(remote_path) else None
+        if remote_size is not None and server.path.isfile(part_path):
+            # a '.part' file left by an earlier upload would be used instead of the remote file
+            server.remove(part_path)
+    if remote_size is None or size < remote_size or offset > remote_size:
+        resumable_upload(ftp_url, local_path, remote_path)
+        return
+
+    def upload():
+        with connection(ftp_url) as server:
+            # after a failed attempt, the remote file was already renamed and its start is still the old one
+            if server.path.isfile(remote_path):
+                server.rename(remote_path, part_path)
+            with open(local_path, 'rb') as source, server.open(part_path, 'wb', rest=offset) as target:
+                source.seek(offset)
+                shutil.copyfileobj(source, target, _chunk_size)
+            metrics.add_bytes('ftp', written=size - offset)
+            server.stat_cache.invalidate(part_path)
+            if server.path.getsize(part_path) != size:
+                raise EOFError(f"Incomplete upload of {remote_path}")
+            digest = server_digest(server, part_path)
+            if digest is not None:
+                same = digest[1] == local_digest(local_path, digest[0])
+            else:
+                same = not verify_hash or same_content(server, part_path, local_path)
+            if not same:
+                server.remove(part_path)
+                return False
+            server.rename(part_path, remote_path)
+            return True
+
+    if not with_retries(upload):
+        resumable_upload(ftp_url, local_path, remote_path)
+
+
+def copy_to_storage(ftp_url: str, file: str, wrap=None):
     """This method copies the file given as parameter from the ftp server at the url given as parameter to the storage
-    If the file is a folder, it copies the files inside it."""
-    server = get_connection(ftp_url)
+    If the file is a folder, it copies the files inside it. The wrap parameter is the one of resumable_download."""
     remote_path = extract_path(ftp_url)
 
     remote_path = remote_path + file
     remote_path = remote_path.removesuffix('/')
 
-    if server.path.isfile(remote_path):
+    with connection(ftp_url) as server:
+        is_file, is_directory = server.path.isfile(remote_path), server.path.isdir(remote_path)
+
+    if is_file:
         local_path = storage_path.replace('\\', '/') + '/' + file
         file_split = local_path.split("/")
         file_name = file_split[len(file_split) - 1]
         os.makedirs(local_path.removesuffix('/' + file_name),
                     exist_ok=True)  # create directory tree needed for the file
-        server.download(remote_path, local_path)
+        # the resumable download borrows its own connection, so this one must be released before
+        resumable_download(ftp_url, remote_path, local_path, wrap)
 
-    if server.path.isdir(remote_path):
+    if is_directory:
         local_path = storage_path.replace('\\', '/') + remote_path
         os.makedirs(local_path)
 
 
-def copy_from_storage(ftp_url: str, file: str):
+def copy_from_storage(ftp_url: str, file: str, wrap=None):
     """This method copies the file given as parameter from from the ftp server
     at the url given as parameter from the storage.
-    If the file is a folder, it copies the files inside it."""
-    server = get_connection(ftp_url)
+    If the file is a folder, it copies the files inside it. The wrap parameter is the one of resumable_upload."""
     ftp_path = extract_path(ftp_url)
 
     local_path = storage_path + '\\' + file
@@ -187,26 +860,98 @@ def copy_from_storage(ftp_url: str, file: str):
         file_split = remote_path.split("/")
         file_name = file_split[len(file_split) - 1]
         if remote_path.removesuffix('/' + file_name) != '':
-            server.makedirs(remote_path.removesuffix('/' + file_name),
-                            exist_ok=True)  # create directory tree needed for the file
-        server.upload(local_path, remote_path)
+            with connection(ftp_url) as server:
+                server.makedirs(remote_path.removesuffix('/' + file_name),
+                                exist_ok=True)  # create directory tree needed for the file
+        resumable_upload(ftp_url, local_path, remote_path, wrap)
 
     if os.path.isdir(local_path):
         remote_path = ftp_path + file.removesuffix('/')
-        if not server.path.exists(remote_path):
-            server.mkdir(remote_path)
+        with connection(ftp_url) as server:
+            if not server.path.exists(remote_path):
+                server.mkdir(remote_path)
+
+
+def copy_files_to_storage(ftp_url: str, files):
+    """This method copies all the files given as parameter from the ftp server at the url given as parameter
+    to the storage, one after another."""
+    for file in files:
+        copy_to_storage(ftp_url, file)
+
+
+def copy_files_from_storage(ftp_url: str, files):
+    """This method copies all the files given as parameter from the storage
+    to the ftp server at the url given as parameter, one after another."""
+    for file in files:
+        copy_from_storage(ftp_url, file)
+
+
+@contextmanager
+def open_file(ftp_url: str, file: str):
+    """This method is used in a with statement to read the file given as parameter from the ftp server
+    at the url given as parameter without downloading it to the storage.
+    It gives a (readable binary stream, file size) tuple."""
+    remote_path = extract_path(ftp_url) + file
+    with connection(ftp_url) as server:
+        size = server.path.getsize(remote_path)
+        with server.open(remote_path, 'rb') as stream:
+            yield stream, size
+        metrics.add_bytes('ftp', read=size)
+
+
+def write_file(ftp_url: str, file: str, stream, size: int = None):
+    """This method uploads the file given as parameter to the ftp server at the url given as parameter
+    with the content read from the binary stream given as parameter in chunks of _chunk_size bytes.
+    The size parameter is not needed by the ftp server, it is there to match the other locations."""
+    remote_path = extract_path(ftp_url) + file
+    with connection(ftp_url) as server:
+        directory = posixpath.dirname(remote_path)
+        if directory != '' and directory != '/':
+            server.makedirs(directory, exist_ok=True)  # create directory tree needed for the file
+        written = 0
+        with server.open(remote_path, 'wb') as target:
+            for chunk in iter(lambda: stream.read(_chunk_size), b""):
+                target.write(chunk)
+                written += len(chunk)
+        metrics.add_bytes('ftp', written=written)
 
 
 def delete_file(ftp_url: str, file: str):
     """This method deletes the file given as parameter
     from the ftp server at the url given as parameter
     If the file is a folder, it deletes all the the files inside it."""
-    server = get_connection(ftp_url)
     ftp_path = extract_path(ftp_url)
 
     path = ftp_path + file
     path = path.removesuffix('/')
-    if server.path.isfile(path):
-        server.remove(path)
-    if server.path.isdir(path):
-        server.rmtree(path)
+    with connection(ftp_url) as server:
+        if server.path.isfile(path):
+            server.remove(path)
+        if server.path.isdir(path):
+            server.rmtree(path)
+
+
+def delete_files(ftp_url: str, files):
+    """This method deletes all the files given as parameter from the ftp server at the url given as parameter,
+    one after another."""
+    for file in files:
+        delete_file(ftp_url, file)
+
+
+def rename_file(ftp_url: str, file: str, new_file: str):
+    """This method renames (or moves) the file given as parameter to new_file on the ftp server
+    at the url given as parameter with the RNFR and RNTO commands, so its content is not sent again."""
+    ftp_path = extract_path(ftp_url)
+    new_path = (ftp_path + new_file).removesuffix('/')
+    with connection(ftp_url) as server:
+        directory = posixpath.dirname(new_path)
+        if directory != '' and directory != '/':
+            server.makedirs(directory, exist_ok=True)
+        server.rename((ftp_path + file).removesuffix('/'), new_path)
+
+
+def rename_files(ftp_url: str, renames):
+    """This method renames all the files given as [old relative path, new relative path] lists
+    on the ftp server at the url given as parameter, one after another."""
+    for file, new_file in renames:
+        rename_file(ftp_url, file, new_file)
@@ -0,0 +1,74 @@
+"""A local ftp server used to try the ftp locations without a real server. It needs pyftpdlib.
+The server also implements the XMD5 command, so the server side hashing can be checked against it:
+
+    python rsync_ftp_server.py <root directory> [port]
+
+and then use the location ftp:user:password@127.0.0.1:<port>/"""
+import hashlib
+import sys
+import threading
+import time
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import FTPServer, ThreadedFTPServer
+
+
+class HashingFTPHandler(FTPHandler):
+    """This class is a pyftpdlib handler which also answers the XMD5 command with the md5 hash of a file"""
+    proto_cmds = dict(FTPHandler.proto_cmds)
+    proto_cmds['XMD5'] = dict(perm='r', auth=True, arg=True, help='Syntax: XMD5 <SP> file-name (get file md5 hash).')
+
+    def __init__(self, conn, server, ioloop=None):
+        """Constructor that announces the XMD5 command in the FEAT response"""
+        super().__init__(conn, server, ioloop)
+        self._extra_feats.append('XMD5')
+
+    def ftp_XMD5(self, path):
+        """This method answers with the md5 hash of the file at the path given as parameter"""
+        hash_md5 = hashlib.md5()
+        try:
+            with self.fs.open(path, 'rb') as file:
+                for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                    hash_md5.update(chunk)
+        except OSError as error:
+            self.respond('550 %s.' % error.strerror)
+            return
+        self.respond('250 ' + hash_md5.hexdigest())
+
+
+def create_server(root: str, port: int = 2121, username: str = 'user', password: str = 'password',
+                  hashing: bool = True, latency: float = 0.0):
+    """This method returns a FTPServer listening on 127.0.0.1 at the port given as parameter (0 for any free port),
+    serving the root directory given as parameter to the user given as parameter with all the permissions.
+    If hashing is False, the server does not support XMD5, like most real servers.
+    If latency is given, the server waits that many seconds before answering each command, like a distant server.
+    Each connection is then served on its own thread, so the waits of different connections overlap."""
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(username, password, root, perm='elradfmwMT')
+    handler = type('Handler', (HashingFTPHandler if hashing else FTPHandler,), {})
+    handler.authorizer = authorizer
+    if latency > 0:
+        def pre_process_command(self, line, cmd, arg):
+            time.sleep(latency)
+            super(handler, self).pre_process_command(line, cmd, arg)
+
+        handler.pre_process_command = pre_process_command
+        return ThreadedFTPServer(('127.0.0.1', port), handler)
+    return FTPServer(('127.0.0.1', port), handler)
+
+
+def get_port(server: FTPServer):
+    """This method returns the port the server given as parameter listens on, useful when it was created with port 0"""
+    return server.socket.getsockname()[1]
+
+
+def start_in_background(server: FTPServer):
+    """This method starts serving with the server given as parameter on a daemon thread and returns that thread.
+    The server is stopped with server.close_all()."""
+    thread = threading.Thread(target=server.serve_forever, kwargs={'handle_exit': False}, daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    create_server(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 2121).serve_forever()
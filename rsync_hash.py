@@ -0,0 +1,100 @@
+import hashlib
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+algorithm: str = 'md5'
+"""the hashlib algorithm of the files hashes: 'md5', 'sha1' or 'blake2b', the last two being faster on most machines.
+Every location must use the same one, so their hashes can be compared."""
+
+buffer_size: int = 1024 * 1024
+"""the number of bytes read at once into a reused buffer when a stream is hashed"""
+
+mmap_threshold: int = 64 * 1024 * 1024
+"""the local files of at least this size are hashed through a memory map instead of being read"""
+
+
+def new(name: str = None):
+    """This method returns a new hashlib object for the algorithm given as parameter
+    (the module algorithm by default)"""
+    return hashlib.new(name or algorithm)
+
+
+def label(hexdigest: str, name: str = None):
+    """This method returns the hash which is stored and compared for the hex digest given as parameter.
+    The md5 hashes are kept as they are, like the ones computed by the ftp servers and remembered in the manifests,
+    the other ones are prefixed by their algorithm, like 'blake2b:...',
+    so hashes of different algorithms never match."""
+    name = name or algorithm
+    return hexdigest if name == 'md5' else f"{name}:{hexdigest}"
+
+
+def algorithm_of(file_hash: str):
+    """This method returns the algorithm of a hash returned by label"""
+    return file_hash.split(':', 1)[0] if ':' in file_hash else 'md5'
+
+
+def update_from_stream(digest, stream, on_chunk=None):
+    """This method updates the hashlib object given as parameter with everything read from the binary stream
+    given as parameter. The bytes are read into a single buffer of buffer_size bytes, so no new bytes object
+    is created for each chunk, when the stream supports readinto. The on_chunk function, if given,
+    is called with the size of every chunk read."""
+    if not hasattr(stream, 'readinto'):
+        for chunk in iter(lambda: stream.read(buffer_size), b""):
+            digest.update(chunk)
+            if on_chunk is not None:
+                on_chunk(len(chunk))
+        return
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    while True:
+        size = stream.readinto(buffer)
+        if not size:
+            return
+        digest.update(view[:size])
+        if on_chunk is not None:
+            on_chunk(size)
+
+
+def hash_stream(stream, name: str = None):
+    """This method returns the labelled hash of everything read from the binary stream given as parameter"""
+    digest = new(name)
+    update_from_stream(digest, stream)
+    return label(digest.hexdigest(), name)
+
+
+def local_hexdigest(path: str, name: str = None):
+    """This method returns the hex digest of the local file at the path given as parameter.
+    The big files are memory mapped and hashed in a single call, which does not hold the GIL,
+    and the other ones are read with hashlib.file_digest when it exists, or else through a reused buffer."""
+    with open(path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size >= mmap_threshold:
+            digest = new(name)
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                digest.update(mapped)
+            return digest.hexdigest()
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(file, name or algorithm).hexdigest()
+        digest = new(name)
+        update_from_stream(digest, file)
+        return digest.hexdigest()
+
+
+def hash_local_file(path: str, name: str = None):
+    """This method returns the labelled hash of the local file at the path given as parameter"""
+    return label(local_hexdigest(path, name), name)
+
+
+def hash_local_files(paths, name: str = None, workers: int = None):
+    """This method returns the list of [path, labelled hash] lists of the local files at the paths given as parameter,
+    hashing them at the same time in workers processes (one for each core by default).
+    The algorithm is given to the workers, so it does not depend on the module algorithm of each process."""
+    paths = list(paths)
+    name = name or algorithm
+    if workers == 1 or len(paths) < 2:
+        return [[path, hash_local_file(path, name)] for path in paths]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        hashes = executor.map(partial(hash_local_file, name=name), paths, chunksize=max(1, len(paths) // 64))
+        return [[path, file_hash] for path, file_hash in zip(paths, hashes)]
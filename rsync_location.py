@@ -1,9 +1,29 @@
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 import rsync_folder as folder
+import rsync_ftp
 import rsync_ftp as ftp
 import rsync_zip as archive
+import rsync_delta as delta
+import rsync_entry as entry
+import rsync_merkle as merkle
+import rsync_planner as planner
+import rsync_metrics as metrics
+from rsync_manifest import Manifest
+
+
+def use_async_ftp(enabled: bool = True):
+    """This function makes the ftp locations use the asyncio backend from rsync_aioftp, which runs the listings,
+    hashing and transfers concurrently, or the ftputil backend from rsync_ftp again if enabled is False.
+    The asyncio backend needs the aioftp package."""
+    global ftp
+    if enabled:
+        import rsync_aioftp
+        ftp = rsync_aioftp
+    else:
+        ftp = rsync_ftp
 
 
 class LocationType(Enum):
@@ -75,57 +95,157 @@ class LocationType(Enum):
             return False
         return True
 
-    def get_hash(self, path):
+    @metrics.instrumented('get_hash')
+    def get_hash(self, path, manifest: Manifest = None):
         """This method calls the specific method for each type of location
-        to get the hash for the path given as parameter"""
+        to get the hash for the path given as parameter.
+        The manifest parameter is used by the zip and ftp locations to skip the files that did not change"""
         if self.value == LocationType.FOLDER.value:
             return folder.get_hash(path)
         if self.value == LocationType.ZIP.value:
-            return archive.get_hash(path)
+            return archive.get_hash(path, manifest)
         if self.value == LocationType.FTP.value:
-            return ftp.get_hash(path)
+            return ftp.get_hash(path, manifest)
 
-    def get_files_list(self, path):
+    @metrics.instrumented('get_files_list')
+    def get_files_list(self, path, workers: int = 1):
         """This method calls the specific method for each type of location
-        to get the files list for the path given as parameter"""
+        to get the files list for the path given as parameter.
+        The workers parameter is the number of parallel connections used by the ftp locations"""
         if self.value == LocationType.FOLDER.value:
             return folder.get_files_list(path)
         if self.value == LocationType.ZIP.value:
             return archive.get_files_list(path)
         if self.value == LocationType.FTP.value:
-            return ftp.get_files_list(path)
+            return ftp.get_files_list(path, workers)
 
-    def copy_file_to_storage(self, path, file):
+    @metrics.instrumented('copy_file_to_storage')
+    def copy_file_to_storage(self, path, file, wrap=None):
         """This method calls the specific method for each type of location
-        to copy the file given as parameter to the storage for the path given as parameter"""
+        to copy the file given as parameter to the storage for the path given as parameter.
+        The wrap parameter is a function which receives the stream read from the location and returns the stream
+        written to the storage, used by the locations that can stream"""
         if self.value == LocationType.FOLDER.value:
             folder.copy_to_storage(path, file)
         if self.value == LocationType.ZIP.value:
-            archive.copy_to_storage(path, file)
+            archive.copy_to_storage(path, file, wrap)
+        if self.value == LocationType.FTP.value:
+            ftp.copy_to_storage(path, file, wrap)
+
+    @metrics.instrumented('copy_files_to_storage')
+    def copy_files_to_storage(self, path, files):
+        """This method calls the specific method for each type of location
+        to copy all the files given as parameter to the storage for the path given as parameter.
+        The ftp locations using the asyncio backend copy them concurrently"""
         if self.value == LocationType.FTP.value:
-            ftp.copy_to_storage(path, file)
+            ftp.copy_files_to_storage(path, files)
+        else:
+            for file in files:
+                self.copy_file_to_storage(path, file)
 
-    def copy_file_from_storage(self, path, file):
+    @metrics.instrumented('copy_file_from_storage')
+    def copy_file_from_storage(self, path, file, wrap=None):
         """This method calls the specific method for each type of location
-        to copy the file given as parameter from the storage for the path given as parameter"""
+        to copy the file given as parameter from the storage for the path given as parameter.
+        The wrap parameter is a function which receives the stream read from the storage and returns the stream
+        written to the location, used by the ftp locations"""
         if self.value == LocationType.FOLDER.value:
             folder.copy_from_storage(path, file)
         if self.value == LocationType.ZIP.value:
             archive.copy_from_storage(path, file)
         if self.value == LocationType.FTP.value:
-            ftp.copy_from_storage(path, file)
+            ftp.copy_from_storage(path, file, wrap)
+
+    def can_stream(self):
+        """This method checks if the location type can read and write files as streams,
+        without going through the storage"""
+        return self.value in (LocationType.FOLDER.value, LocationType.ZIP.value, LocationType.FTP.value)
+
+    def can_patch(self):
+        """This method checks if the files of this type of location can be changed in place,
+        so only the blocks which changed are written: the folders can, the ftp servers from an offset."""
+        return self.value in (LocationType.FOLDER.value, LocationType.FTP.value)
 
-    def get_files_with_hash(self, path):
+    def rewrites_on_write(self):
+        """This method checks if every write to this type of location rewrites all of it, like a zip archive does,
+        so its files must be written in batches"""
+        return self.value == LocationType.ZIP.value
+
+    def open_file(self, path, file):
+        """This method calls the specific method for each type of location that can stream
+        to open the file given as parameter for reading for the path given as parameter.
+        It is used in a with statement and gives a (readable binary stream, file size) tuple"""
+        if self.value == LocationType.FOLDER.value:
+            return entry.open_folder_file(path, file)
+        if self.value == LocationType.ZIP.value:
+            return archive.open_file(path, file)
+        if self.value == LocationType.FTP.value:
+            return ftp.open_file(path, file)
+
+    @metrics.instrumented('write_file')
+    def write_file(self, path, file, stream, size: int = None):
+        """This method calls the specific method for each type of location that can stream
+        to write the file given as parameter with the content of the stream for the path given as parameter"""
+        if self.value == LocationType.FOLDER.value:
+            entry.write_folder_file(path, file, stream, size)
+        if self.value == LocationType.ZIP.value:
+            archive.write_file(path, file, stream, size)
+        if self.value == LocationType.FTP.value:
+            ftp.write_file(path, file, stream, size)
+
+    @metrics.instrumented('copy_files_from_storage')
+    def copy_files_from_storage(self, path, files):
+        """This method calls the specific method for each type of location
+        to copy all the files given as parameter from the storage for the path given as parameter.
+        The zip locations apply all of them in a single rewrite of the archive
+        and the ftp locations using the asyncio backend copy them concurrently"""
+        if self.value == LocationType.ZIP.value:
+            archive.copy_files_from_storage(path, files)
+        elif self.value == LocationType.FTP.value:
+            ftp.copy_files_from_storage(path, files)
+        else:
+            for file in files:
+                self.copy_file_from_storage(path, file)
+
+    @metrics.instrumented('get_files_with_hash')
+    def get_files_with_hash(self, path, workers: int = 1, manifest: Manifest = None):
         """This method calls the specific method for each type of location
         to get a list of lists where the first element is a file path and the second element is it's hash
-         for the path given as parameter"""
+         for the path given as parameter.
+         The workers parameter is the number of parallel connections used by the ftp locations
+         and the manifest parameter is used to skip the files that did not change"""
+        if self.value == LocationType.FOLDER.value:
+            # rsync_folder only hashes with md5, the entries use rsync_hash.algorithm like the other locations
+            files_list = [item.to_list() for item in entry.iter_folder(path, manifest)]
+            if manifest is not None:
+                manifest.forget_unseen()
+            return files_list
+        if self.value == LocationType.ZIP.value:
+            return archive.get_files_with_hash(path, manifest=manifest)
+        if self.value == LocationType.FTP.value:
+            return ftp.get_files_with_hash(path, workers, manifest)
+
+    def iter_entries(self, path, manifest: Manifest = None):
+        """This method calls the specific generator for each type of location
+        to yield a FileEntry for every file and directory for the path given as parameter, in sort_key order.
+        It is not instrumented, as the work happens while the entries are consumed."""
         if self.value == LocationType.FOLDER.value:
-            return folder.get_files_with_hash(path)
+            return entry.iter_folder(path, manifest)
         if self.value == LocationType.ZIP.value:
-            return archive.get_files_with_hash(path)
+            return archive.iter_entries(path, manifest)
         if self.value == LocationType.FTP.value:
-            return ftp.get_files_with_hash(path)
+            return ftp.iter_entries(path, manifest)
 
+    def get_mtime_precision(self):
+        """This method returns the seconds the modification times of each type of location can be off by,
+        so their manifests do not trust a hash taken too soon after a modification"""
+        if self.value == LocationType.ZIP.value:
+            return archive.mtime_precision
+        if self.value == LocationType.FTP.value:
+            return rsync_ftp.mtime_precision
+        return None
+
+    @metrics.instrumented('get_last_modification_date_of_file')
     def get_last_modification_date_of_file(self, path, file):
         """This method calls the specific method for each type of location
         to get the last modification date of the file given as parameter for the path given as parameter"""
@@ -136,6 +256,27 @@ class LocationType(Enum):
         if self.value == LocationType.FTP.value:
             return ftp.get_last_modification_date_of_file(path, file)
 
+    @metrics.instrumented('stat_snapshot')
+    def stat_snapshot(self, path):
+        """This method calls the specific method for each type of location
+        to get the size, modification time and type of every file for the path given as parameter in a single pass"""
+        if self.value == LocationType.ZIP.value:
+            return archive.stat_snapshot(path)
+        if self.value == LocationType.FTP.value:
+            return ftp.stat_snapshot(path)
+        snapshot = {}
+        for root, dirs, files in os.walk(path):
+            prefix = os.path.relpath(root, path).replace('\\', '/')
+            prefix = '' if prefix == '.' else prefix + '/'
+            for directory in dirs:
+                result = os.stat(os.path.join(root, directory))
+                snapshot[prefix + directory + '/'] = [0, result.st_mtime, 'directory']
+            for file in files:
+                result = os.stat(os.path.join(root, file))
+                snapshot[prefix + file] = [result.st_size, result.st_mtime, 'file']
+        return snapshot
+
+    @metrics.instrumented('delete_file')
     def delete_file(self, path, file):
         """This method calls the specific method for each type of location
         delete the file specified as parameter for the path given as parameter"""
@@ -146,6 +287,35 @@ class LocationType(Enum):
         if self.value == LocationType.FTP.value:
             return ftp.delete_file(path, file)
 
+    @metrics.instrumented('delete_files')
+    def delete_files(self, path, files):
+        """This method calls the specific method for each type of location
+        to delete all the files given as parameter for the path given as parameter.
+        The zip locations apply all of them in a single rewrite of the archive"""
+        if self.value == LocationType.ZIP.value:
+            archive.delete_files(path, files)
+        elif self.value == LocationType.FTP.value:
+            ftp.delete_files(path, files)
+        else:
+            for file in files:
+                self.delete_file(path, file)
+
+    @metrics.instrumented('rename_files')
+    def rename_files(self, path, renames):
+        """This method calls the specific method for each type of location
+        to rename all the files given as [old relative path, new relative path] lists for the path given as parameter.
+        The content is never copied again: the folder locations move the files, the ftp locations use RNFR and RNTO
+        and the zip locations copy the compressed members under their new names in a single rewrite."""
+        if self.value == LocationType.FOLDER.value:
+            for file, new_file in renames:
+                new_path = os.path.join(path, new_file.removesuffix('/'))
+                os.makedirs(os.path.dirname(new_path), exist_ok=True)
+                os.replace(os.path.join(path, file.removesuffix('/')), new_path)
+        elif self.value == LocationType.ZIP.value:
+            archive.rename_files(path, renames)
+        elif self.value == LocationType.FTP.value:
+            ftp.rename_files(path, renames)
+
 
 class Location:
     """This class holds a location information:
@@ -153,6 +323,7 @@ class Location:
     It also calls methods to execute tasks required to keep two locations synchronised."""
     type: LocationType
     path: str
+    manifest: Manifest = None
 
     def __init__(self, location_string: str):
         """Constructor that creates type LocationType enums and creates the path from the location url parameter"""
@@ -174,31 +345,176 @@ class Location:
             exit(-1)
         return Location(input_string)
 
+    def open_manifest(self, force_rehash: bool = False):
+        """Opens the hash manifest of this location, so the files that did not change are not hashed again.
+        If force_rehash is True, every file is hashed again and the manifest is rebuilt."""
+        self.close_manifest()
+        self.manifest = Manifest(f"{self.type.name.lower()}:{self.path}", force_rehash,
+                                 precision=self.type.get_mtime_precision())
+
+    def close_manifest(self):
+        """Saves and closes the hash manifest of this location, if it was opened."""
+        if self.manifest is not None:
+            self.manifest.close()
+            self.manifest = None
+
+    def set_compression(self, method: int = None, level: int = None):
+        """Sets the compression method and level of the files written from now on in this location.
+        Only the zip locations compress their files, the other locations ignore it."""
+        if self.type == LocationType.ZIP:
+            archive.set_compression(self.path, method, level)
+
     def get_hash(self):
         """Calls the get hash method for it's corresponding type and path."""
-        return self.type.get_hash(self.path)
+        return self.type.get_hash(self.path, self.manifest)
 
-    def get_files_list(self):
+    def get_files_list(self, workers: int = 1):
         """Calls the get files list method for it's corresponding type and path."""
-        return self.type.get_files_list(self.path)
+        return self.type.get_files_list(self.path, workers)
 
-    def copy_file_to_storage(self, file):
+    def copy_file_to_storage(self, file, wrap=None):
         """Calls the copy file to storage method for the file parameter for it's corresponding type and path."""
-        self.type.copy_file_to_storage(self.path, file)
+        self.type.copy_file_to_storage(self.path, file, wrap)
+
+    def copy_files_to_storage(self, files):
+        """Calls the copy files to storage method for the files parameter for it's corresponding type and path."""
+        self.type.copy_files_to_storage(self.path, files)
 
-    def copy_file_from_storage(self, file):
+    def copy_file_from_storage(self, file, wrap=None):
         """Calls the copy file from storage method for the file parameter for it's corresponding type and path."""
-        self.type.copy_file_from_storage(self.path, file)
+        self.type.copy_file_from_storage(self.path, file, wrap)
 
-    def get_files_with_hash(self):
+    def copy_files_from_storage(self, files):
+        """Calls the copy files from storage method for the files parameter for it's corresponding type and path."""
+        self.type.copy_files_from_storage(self.path, files)
+
+    def transfer_to(self, other, file, wrap=None):
+        """Copies the file given as parameter from this location to the other location given as parameter.
+        The content is streamed from one location to the other in bounded chunks when both can do it,
+        otherwise it goes through the storage. Directories always go through the storage, as they have no content.
+        The wrap parameter is a function which receives the stream read from this location and returns the stream
+        given to the other location, used to follow or limit the bytes streamed. Through the storage, it wraps the
+        stream read from this location if it can stream, or else the one written to the other location."""
+        if not file.endswith('/') and self.type.can_stream() and other.type.can_stream():
+            with self.type.open_file(self.path, file) as (stream, size):
+                other.type.write_file(other.path, file, stream if wrap is None else wrap(stream), size)
+        elif self.type.can_stream():
+            self.copy_file_to_storage(file, wrap)
+            other.copy_file_from_storage(file)
+        else:
+            self.copy_file_to_storage(file)
+            other.copy_file_from_storage(file, wrap)
+
+    def delta_transfer_to(self, other, file, wrap=None):
+        """Copies the file given as parameter from this location to the other location given as parameter
+        writing only the blocks which changed, when the other location has an older copy it can patch.
+        A folder copy is patched in place with the content streamed from this location (or staged in the storage).
+        A ftp copy is patched when the old copy staged in the storage is the same as it, checked by hash without
+        downloading it: the staged copy is patched first and only its changed end is uploaded.
+        Otherwise, or when too much of the file changed for the patch to be worth it (see rsync_delta.patch_file),
+        the file is copied whole with transfer_to or through the storage.
+        The wrap parameter is the one of transfer_to, it wraps the new content read from this location or from the
+        storage, so the bytes read by a patch given up are followed or limited too."""
+        if file.endswith('/') or not other.type.can_patch():
+            return self.transfer_to(other, file, wrap)
+        storage_file = rsync_ftp.storage_path + '\\' + file
+        if other.type == LocationType.FOLDER:
+            local_path = os.path.join(other.path, file)
+            if not os.path.isfile(local_path):
+                return self.transfer_to(other, file, wrap)
+            if self.type.can_stream():
+                with self.type.open_file(self.path, file) as (stream, size):
+                    patched = delta.patch_file(local_path, stream if wrap is None else wrap(stream))
+                if patched is None:
+                    self.transfer_to(other, file, wrap)
+            else:
+                self.copy_file_to_storage(file)
+                with open(storage_file, 'rb') as stream:
+                    patched = delta.patch_file(local_path, stream if wrap is None else wrap(stream))
+                if patched is None:
+                    other.copy_file_from_storage(file, wrap)
+            return
+        remote_path = rsync_ftp.extract_path(other.path) + file
+        if self.type.can_stream() and os.path.isfile(storage_file) and \
+                rsync_ftp.same_remote_copy(other.path, remote_path, storage_file, other.manifest, file):
+            with self.type.open_file(self.path, file) as (stream, size):
+                patched = delta.patch_file(storage_file, stream if wrap is None else wrap(stream))
+            if patched is not None:
+                rsync_ftp.patch_upload(other.path, storage_file, remote_path, patched[2])
+                return
+        self.copy_file_to_storage(file, wrap)
+        other.copy_file_from_storage(file)
+
+    def get_files_with_hash(self, workers: int = 1):
         """Calls the get files with hash method for it's corresponding type and path."""
-        return self.type.get_files_with_hash(self.path)
+        return self.type.get_files_with_hash(self.path, workers, self.manifest)
+
+    def iter_entries(self):
+        """Calls the iter entries method for it's corresponding type and path.
+        It yields the FileEntry objects one by one, sorted by path, with their hashes computed lazily."""
+        return self.type.iter_entries(self.path, self.manifest)
+
+    def diff_entries(self, other):
+        """Yields the [relative path, change] lists which are different in this location compared with
+        the other location given as parameter, walking both locations at the same time without listing them first."""
+        return entry.diff(self.iter_entries(), other.iter_entries())
+
+    def get_merkle_tree(self, workers: int = 1):
+        """Returns the root MerkleNode of this location, holding a hash for every file and directory.
+        It is built from get_files_with_hash, so every file is listed and hashed (the manifest only skips reading
+        the unchanged ones) and its cost grows with the size of the location, not with the size of the change."""
+        return merkle.build_tree(self.get_files_with_hash(workers))
+
+    def diff(self, other, workers: int = 1):
+        """Returns the list of [relative path, change] lists which are different in this location compared with
+        the other location given as parameter, descending only into the directories whose hashes differ.
+        Both trees are built whole first, so this only makes the comparison skip the same subtrees and report an
+        added or deleted directory once, it reads as much as comparing the lists of get_files_with_hash."""
+        return merkle.diff(self.get_merkle_tree(workers), other.get_merkle_tree(workers))
 
     def get_last_modification_date_of_file(self, file):
         """Calls the get last modification date of file method for the file parameter
          for it's corresponding type and path."""
         return self.type.get_last_modification_date_of_file(self.path, file)
 
+    def stat_snapshot(self):
+        """Calls the stat snapshot method for it's corresponding type and path.
+        It returns a dictionary mapping every relative path to a [size, modification time, type] list."""
+        return self.type.stat_snapshot(self.path)
+
     def delete_file(self, file):
         """Calls the delete file method for the file parameter for it's corresponding type and path."""
         return self.type.delete_file(self.path, file)
+
+    def delete_files(self, files):
+        """Calls the delete files method for the files parameter for it's corresponding type and path."""
+        self.type.delete_files(self.path, files)
+
+    def rename_files(self, renames):
+        """Calls the rename files method for the [old path, new path] lists parameter
+        for it's corresponding type and path."""
+        self.type.rename_files(self.path, renames)
+
+    def plan_sync(self, other, workers: int = 1):
+        """Returns the actions which make the other location given as parameter the same as this location.
+        The files which were only renamed or moved are found by their hashes and renamed instead of copied."""
+        return planner.plan(self.get_files_with_hash(workers), other.get_files_with_hash(workers))
+
+    def sync_to(self, other, workers: int = 1, scheduler=None):
+        """Makes the other location given as parameter the same as this location and returns the actions applied.
+        If a rsync_scheduler.Scheduler is given, the copies and deletes are run by it."""
+        actions = self.plan_sync(other, workers)
+        planner.apply(actions, self, other, scheduler)
+        return actions
+
+    def sync_to_many(self, others, workers: int = 1):
+        """Makes every location from the others list given as parameter the same as this location
+        and returns the list of actions applied to each of them.
+        This location is listed and hashed once and each changed file is read from it once,
+        then all the other locations are listed and written in parallel."""
+        files_with_hash = self.get_files_with_hash(workers)
+        with ThreadPoolExecutor(max_workers=max(1, len(others))) as executor:
+            actions_lists = list(executor.map(
+                lambda other: planner.plan(files_with_hash, other.get_files_with_hash(workers)), others))
+        planner.apply_to_many(actions_lists, self, others)
+        return actions_lists
@@ -0,0 +1,136 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import rsync_hash
+
+manifest_directory: str = "E:\\Info\\FACULTATE\\ANUL_3\\PYTHON\\PROIECT\\Advanced RSync\\manifests"
+"""the directory where a manifest file is kept for each location"""
+
+max_entries: int = 1000000
+"""the maximum number of files remembered by a manifest, the ones not seen for the longest time are dropped first"""
+
+mtime_precision: float = 2.0
+"""the default number of seconds a modification time can be off by, the ftp listings and the zip members have their
+own. A local folder has 2 seconds on FAT disks."""
+
+
+def metadata_signature(entries):
+    """This method returns a hash of the (path, size, mtime) entries given as parameter, in sorted order.
+    Two trees with the same signature have the same files with the same sizes and modification times."""
+    signature = hashlib.md5()
+    for path, size, mtime in sorted(entries):
+        signature.update(f"{path}\0{size}\0{mtime}\0".encode('UTF-8'))
+    return signature.hexdigest()
+
+
+class Manifest:
+    """This class holds the hashes computed for the files of a location in a SQLite file,
+    together with the size and modification time each file had when it was hashed.
+    A file whose size and modification time did not change gets its hash back without being read again.
+    Like the racy entries of the git index, a hash taken less than the precision of the modification times after
+    the file was modified is not trusted: the file could have changed again without its time changing."""
+
+    def __init__(self, location: str, force_rehash: bool = False, max_size: int = None, precision: float = None):
+        """Constructor that opens (or creates) the manifest of the location url given as parameter.
+        If force_rehash is True, all the remembered hashes are dropped so every file is read again.
+        The max_size parameter overrides the max_entries limit for this manifest and the precision parameter
+        overrides mtime_precision, for the modification times of the location."""
+        os.makedirs(manifest_directory, exist_ok=True)
+        file_name = hashlib.md5(location.encode('UTF-8')).hexdigest() + '.sqlite'
+        self.path = os.path.join(manifest_directory, file_name)
+        self.max_size = max_entries if max_size is None else max_size
+        self.precision = mtime_precision if precision is None else precision
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, size INTEGER, mtime REAL, hash TEXT, run INTEGER, hashed REAL);
+            CREATE TABLE IF NOT EXISTS tree (
+                id INTEGER PRIMARY KEY CHECK (id = 0), signature TEXT, hash TEXT);
+            CREATE TABLE IF NOT EXISTS meta (
+                id INTEGER PRIMARY KEY CHECK (id = 0), run INTEGER);
+            INSERT OR IGNORE INTO meta VALUES (0, 0);
+        ''')
+        columns = [column[1] for column in self._connection.execute("PRAGMA table_info(files)")]
+        if 'hashed' not in columns:
+            # the files remembered by an older manifest have no hashing time, they are all hashed again once
+            self._connection.execute("ALTER TABLE files ADD COLUMN hashed REAL DEFAULT 0")
+        if force_rehash:
+            self.clear()
+        self._run = self._connection.execute("SELECT run FROM meta").fetchone()[0] + 1
+        self._connection.execute("UPDATE meta SET run = ?", (self._run,))
+
+    def get_hash(self, path: str, size, mtime):
+        """This method returns the remembered hash of the file given as parameter
+        OR None if it was never hashed, its size or modification time changed since then,
+        it was hashed less than the precision after it was modified
+        or it was hashed with another algorithm than rsync_hash.algorithm."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT size, mtime, hash, hashed FROM files WHERE path = ?", (path,)).fetchone()
+            if row is None or row[0] != size or row[1] != mtime:
+                return None
+            # a change within the precision of the modification time after the hashing would keep the same time
+            if row[3] - mtime <= self.precision:
+                return None
+            # a hash of another algorithm can not be compared with the hashes computed now
+            if rsync_hash.algorithm_of(row[2]) != rsync_hash.algorithm:
+                return None
+            self._connection.execute("UPDATE files SET run = ? WHERE path = ?", (self._run, path))
+            return row[2]
+
+    def set_hash(self, path: str, size, mtime, file_hash: str, hashed: float = None):
+        """This method remembers the hash of the file given as parameter for the size and modification time it has.
+        The hashed parameter is the time the file started being read, now by default."""
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                                     (path, size, mtime, file_hash, self._run,
+                                      time.time() if hashed is None else hashed))
+
+    def get_tree_hash(self, signature: str):
+        """This method returns the remembered hash of the whole location
+        OR None if its metadata signature changed since it was computed."""
+        with self._lock:
+            row = self._connection.execute("SELECT signature, hash FROM tree").fetchone()
+            if row is None or row[0] != signature:
+                return None
+            return row[1]
+
+    def set_tree_hash(self, signature: str, tree_hash: str, newest: float = None):
+        """This method remembers the hash of the whole location for the metadata signature given as parameter.
+        It is not remembered if the newest modification time of its files is within the precision of now."""
+        if newest is not None and time.time() - newest <= self.precision:
+            return
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO tree VALUES (0, ?, ?)", (signature, tree_hash))
+
+    def clear(self):
+        """This method forgets all the remembered hashes"""
+        with self._lock:
+            self._connection.execute("DELETE FROM files")
+            self._connection.execute("DELETE FROM tree")
+            self._connection.commit()
+
+    def forget_unseen(self):
+        """This method forgets the files which were not looked up or hashed during this run.
+        It must be called only after the whole location was scanned, when those files are known to be deleted."""
+        with self._lock:
+            self._connection.execute("DELETE FROM files WHERE run < ?", (self._run,))
+
+    def close(self):
+        """This method trims the manifest to its maximum size, keeping the most recently seen files,
+        then saves it and closes its file."""
+        with self._lock:
+            self._connection.execute('''
+                DELETE FROM files WHERE path IN (
+                    SELECT path FROM files ORDER BY run DESC LIMIT -1 OFFSET ?)''', (self.max_size,))
+            self._connection.commit()
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,91 @@
+import hashlib
+
+
+class MerkleNode:
+    """This class holds a file or a directory of a location tree together with its hash.
+    A file's hash is its content hash, while a directory's hash is created from the names, types and hashes
+    of everything inside it, so two directories have the same hash only if their whole subtrees are the same."""
+
+    def __init__(self, path: str, is_directory: bool, file_hash: str = None):
+        """Constructor that creates a node for the relative path given as parameter.
+        Directories paths end with '/' like in the files lists, the root directory path being ''."""
+        self.path = path
+        self.is_directory = is_directory
+        self.hash = file_hash
+        self.children = {} if is_directory else None
+
+    def get_child(self, name: str, is_directory: bool):
+        """This method returns the child node with the name given as parameter, creating it if it does not exist"""
+        if name not in self.children:
+            if is_directory:
+                self.children[name] = MerkleNode(self.path + name + '/', True)
+            else:
+                self.children[name] = MerkleNode(self.path + name, False)
+        return self.children[name]
+
+    def compute_hash(self):
+        """This method computes the hashes of this directory and all the directories inside it and returns it"""
+        if not self.is_directory:
+            return self.hash
+        hash_md5 = hashlib.md5()
+        for name in sorted(self.children):
+            child = self.children[name]
+            kind = 'd' if child.is_directory else 'f'
+            hash_md5.update(f"{name}\0{kind}\0{child.compute_hash()}\0".encode('UTF-8'))
+        self.hash = hash_md5.hexdigest()
+        return self.hash
+
+    def find(self, path: str):
+        """This method returns the node at the relative path given as parameter OR None if it does not exist"""
+        node = self
+        for name in [name for name in path.split('/') if name != '']:
+            if not node.is_directory or name not in node.children:
+                return None
+            node = node.children[name]
+        return node
+
+
+def build_tree(files_with_hash):
+    """This method returns the root MerkleNode built from a list of lists like the one returned
+    by get_files_with_hash, where directories have the "directory" hash."""
+    root = MerkleNode('', True)
+    for path, file_hash in files_with_hash:
+        is_directory = file_hash == "directory"
+        names = [name for name in path.split('/') if name != '']
+        if not names:
+            continue
+        node = root
+        for name in names[:-1]:
+            node = node.get_child(name, True)
+        node = node.get_child(names[-1], is_directory)
+        if not is_directory:
+            node.hash = file_hash
+    root.compute_hash()
+    return root
+
+
+def diff(source: MerkleNode, destination: MerkleNode):
+    """This method returns a list of [relative path, change] lists describing what is different in the source tree
+    compared with the destination tree, where change is 'added', 'deleted' or 'changed'.
+    Only the directories whose hashes differ are descended into, and a directory which exists only on one side
+    is reported once, without its content. The trees must be built whole first: the directory hashes are not
+    remembered between runs, so the work saved is the comparison, not the listing and hashing of the files."""
+    changes = []
+    if source.hash == destination.hash:
+        return changes
+    for name in sorted(set(source.children) | set(destination.children)):
+        source_child = source.children.get(name)
+        destination_child = destination.children.get(name)
+        if destination_child is None:
+            changes.append([source_child.path, 'added'])
+        elif source_child is None:
+            changes.append([destination_child.path, 'deleted'])
+        elif source_child.is_directory != destination_child.is_directory:
+            changes.append([destination_child.path, 'deleted'])
+            changes.append([source_child.path, 'added'])
+        elif source_child.hash != destination_child.hash:
+            if source_child.is_directory:
+                changes.extend(diff(source_child, destination_child))
+            else:
+                changes.append([source_child.path, 'changed'])
+    return changes
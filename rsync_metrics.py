@@ -0,0 +1,203 @@
+import cProfile
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+enabled: bool = False
+"""if False, nothing is recorded and the instrumented operations cost a single check"""
+
+buckets = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0]
+"""the upper bounds in seconds of the latency histogram buckets, the last bucket holds everything slower"""
+
+_lock = threading.Lock()
+
+_operations = {}
+"""maps a (backend, operation) key to its [calls, errors, total seconds, bucket counts, bytes read, bytes written]"""
+
+_counters = {}
+"""maps a (backend, counter name) key, like ('ftp', 'connections') or ('zip', 'retries'), to its value"""
+
+_current = threading.local()
+"""the stack of (backend, operation) keys running on the current thread, to know where the bytes are counted"""
+
+_trace_hook = None
+
+
+def enable(value: bool = True):
+    """This method starts (or stops, if value is False) recording the operations"""
+    global enabled
+    enabled = value
+
+
+def reset():
+    """This method forgets everything recorded until now"""
+    with _lock:
+        _operations.clear()
+        _counters.clear()
+
+
+def set_trace_hook(hook):
+    """This method sets a function called after each instrumented operation with the backend, the operation name,
+    the seconds it took and the exception it raised (or None), so the operations can be sent to a tracing system.
+    Passing None removes the hook."""
+    global _trace_hook
+    _trace_hook = hook
+
+
+def _entry(key):
+    """This method returns the record of the (backend, operation) key given as parameter, creating it if needed.
+    It must be called while holding the lock."""
+    if key not in _operations:
+        _operations[key] = [0, 0, 0.0, [0] * (len(buckets) + 1), 0, 0]
+    return _operations[key]
+
+
+def instrumented(operation: str):
+    """This decorator records the calls, errors and latency of a LocationType method under the operation name
+    given as parameter, for the backend of the LocationType it is called on."""
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not enabled:
+                return method(self, *args, **kwargs)
+            key = (self.name.lower(), operation)
+            stack = getattr(_current, 'stack', None)
+            if stack is None:
+                stack = _current.stack = []
+            stack.append(key)
+            error = None
+            start = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            except BaseException as exception:
+                error = exception
+                raise
+            finally:
+                seconds = time.perf_counter() - start
+                stack.pop()
+                record(key, seconds, error is not None)
+                if _trace_hook is not None:
+                    _trace_hook(key[0], operation, seconds, error)
+
+        return wrapper
+
+    return decorator
+
+
+def record(key, seconds: float, failed: bool = False):
+    """This method records one call of the (backend, operation) key given as parameter which took seconds"""
+    with _lock:
+        entry = _entry(key)
+        entry[0] += 1
+        if failed:
+            entry[1] += 1
+        entry[2] += seconds
+        index = 0
+        while index < len(buckets) and seconds > buckets[index]:
+            index += 1
+        entry[3][index] += 1
+
+
+def add_bytes(backend: str, read: int = 0, written: int = 0):
+    """This method counts bytes read from or written to a location of the backend given as parameter.
+    They are added to the instrumented operation running on the current thread, or to 'other' if there is none."""
+    if not enabled:
+        return
+    stack = getattr(_current, 'stack', None)
+    key = stack[-1] if stack else (backend, 'other')
+    with _lock:
+        entry = _entry(key)
+        entry[4] += read
+        entry[5] += written
+
+
+def count(backend: str, name: str, value: int = 1):
+    """This method adds value to the counter with the name given as parameter for the backend given as parameter,
+    like the number of connections opened or retries"""
+    if not enabled:
+        return
+    with _lock:
+        _counters[(backend, name)] = _counters.get((backend, name), 0) + value
+
+
+def snapshot():
+    """This method returns everything recorded until now as a dictionary which can be saved as JSON"""
+    with _lock:
+        operations = []
+        for (backend, operation), entry in sorted(_operations.items()):
+            operations.append({
+                'backend': backend,
+                'operation': operation,
+                'calls': entry[0],
+                'errors': entry[1],
+                'seconds': entry[2],
+                'histogram': dict(zip([str(bound) for bound in buckets] + ['+Inf'], entry[3])),
+                'bytes_read': entry[4],
+                'bytes_written': entry[5],
+            })
+        counters = [{'backend': backend, 'name': name, 'value': value}
+                    for (backend, name), value in sorted(_counters.items())]
+    return {'operations': operations, 'counters': counters}
+
+
+def to_json():
+    """This method returns everything recorded until now as a JSON string"""
+    return json.dumps(snapshot(), indent=2)
+
+
+def to_prometheus():
+    """This method returns everything recorded until now in the Prometheus text exposition format"""
+    data = snapshot()
+    lines = ['# TYPE rsync_operation_seconds histogram']
+    for operation in data['operations']:
+        labels = f'backend="{operation["backend"]}",operation="{operation["operation"]}"'
+        cumulative = 0
+        for bound, value in operation['histogram'].items():
+            cumulative += value
+            lines.append(f'rsync_operation_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'rsync_operation_seconds_sum{{{labels}}} {operation["seconds"]}')
+        lines.append(f'rsync_operation_seconds_count{{{labels}}} {operation["calls"]}')
+    for name, field in (('errors', 'errors'), ('bytes_read', 'bytes_read'), ('bytes_written', 'bytes_written')):
+        lines.append(f'# TYPE rsync_operation_{name}_total counter')
+        for operation in data['operations']:
+            labels = f'backend="{operation["backend"]}",operation="{operation["operation"]}"'
+            lines.append(f'rsync_operation_{name}_total{{{labels}}} {operation[field]}')
+    lines.append('# TYPE rsync_events_total counter')
+    for counter in data['counters']:
+        lines.append(f'rsync_events_total{{backend="{counter["backend"]}",name="{counter["name"]}"}} '
+                     f'{counter["value"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def summary():
+    """This method returns a table with the calls, errors, total and average latency and bytes of each operation,
+    followed by the counters, to be printed at the end of a run"""
+    data = snapshot()
+    lines = [f"{'backend':<8} {'operation':<28} {'calls':>7} {'errors':>6} {'total s':>9} {'avg ms':>9} "
+             f"{'read MB':>9} {'written MB':>10}"]
+    for operation in data['operations']:
+        average = operation['seconds'] / operation['calls'] * 1000 if operation['calls'] else 0.0
+        lines.append(f"{operation['backend']:<8} {operation['operation']:<28} {operation['calls']:>7} "
+                     f"{operation['errors']:>6} {operation['seconds']:>9.3f} {average:>9.2f} "
+                     f"{operation['bytes_read'] / 1e6:>9.2f} {operation['bytes_written'] / 1e6:>10.2f}")
+    for counter in data['counters']:
+        lines.append(f"{counter['backend']:<8} {counter['name']:<28} {counter['value']:>7}")
+    return '\n'.join(lines)
+
+
+@contextmanager
+def profile(output_path: str = None):
+    """This method is used in a with statement to run the block under cProfile.
+    The statistics are written to output_path if it is given, so they can be read with pstats or snakeviz,
+    and the profiler is given to the block so it can print them itself."""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if output_path is not None:
+            profiler.dump_stats(output_path)
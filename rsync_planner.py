@@ -0,0 +1,143 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
+def is_inside(path: str, directories):
+    """This method checks if the relative path given as parameter is inside one of the directories given as parameter"""
+    for directory in directories:
+        if path != directory and path.startswith(directory):
+            return True
+    return False
+
+
+def plan(source_files, destination_files):
+    """This method returns the list of actions which make the destination the same as the source,
+    both given as lists of [relative path, hash] lists like the ones returned by get_files_with_hash.
+    The actions are ['rename', old path, new path], ['copy', path], ['update', path] and ['delete', path] lists,
+    an update being the copy of a file which the destination has with another content, in the order
+    they must be applied: a file missing from the destination whose content is already there, in a file which
+    is going to be deleted, is renamed instead of being copied again."""
+    source = dict(source_files)
+    destination = dict(destination_files)
+
+    # hash -> destination paths which are not in the source, so they can be moved without losing anything
+    movable = {}
+    for path, file_hash in destination_files:
+        if file_hash != "directory" and path not in source:
+            movable.setdefault(file_hash, []).append(path)
+
+    renames, copies = [], []
+    moved = set()
+    for path, file_hash in source_files:
+        if path in destination and destination[path] == file_hash:
+            continue
+        if file_hash != "directory" and path not in destination and movable.get(file_hash):
+            old_path = movable[file_hash].pop()
+            moved.add(old_path)
+            renames.append(['rename', old_path, path])
+        else:
+            copies.append(['update' if path in destination and file_hash != "directory"
+                           and destination[path] != "directory" else 'copy', path])
+    # the directories are created before the files inside them
+    copies.sort(key=lambda action: not action[1].endswith('/'))
+
+    deleted_directories = [path for path, file_hash in destination_files
+                           if file_hash == "directory" and path not in source]
+    deletes = []
+    for path, file_hash in destination_files:
+        if path in source or path in moved or is_inside(path, deleted_directories):
+            continue
+        deletes.append(['delete', path])
+
+    return renames + copies + deletes
+
+
+def apply(actions, source, destination, scheduler=None):
+    """This method applies the actions returned by plan from the source location to the destination location.
+    The renames and deletes are done in batches, so a zip destination is rewritten only once for each of them,
+    and so are the copies to a zip destination, which are staged in the storage first.
+    If a rsync_scheduler.Scheduler is given, the directories are created first and then the files copies
+    and the deletes are queued in it and run by priority, within its limits."""
+    renames = [[action[1], action[2]] for action in actions if action[0] == 'rename']
+    if renames:
+        destination.rename_files(renames)
+    if scheduler is not None:
+        schedule(actions, source, destination, scheduler)
+        return
+    if destination.type.rewrites_on_write():
+        copies = [action[1] for action in actions if action[0] in ('copy', 'update')]
+        if copies:
+            source.copy_files_to_storage(copies)
+            destination.copy_files_from_storage(copies)
+    else:
+        for action in actions:
+            if action[0] == 'copy':
+                source.transfer_to(destination, action[1])
+            elif action[0] == 'update':
+                source.delta_transfer_to(destination, action[1])
+    deletes = [action[1] for action in actions if action[0] == 'delete']
+    if deletes:
+        destination.delete_files(deletes)
+
+
+def apply_to_many(actions_lists, source, destinations):
+    """This method applies to each destination location its actions from actions_lists, returned by plan.
+    Every file which must be copied is read from the source only once, into the storage, even if many destinations
+    need it, and then the destinations are written in parallel from that single staged copy.
+    The renames are applied before the copies and the deletes after them, like in apply."""
+    # a dictionary keeps the first order the files are found in, without a list scan for each of them
+    staged = list(dict.fromkeys(action[1] for actions in actions_lists for action in actions
+                                if action[0] in ('copy', 'update')))
+    # the directories are staged before the files inside them
+    staged.sort(key=lambda path: not path.endswith('/'))
+
+    def rename(destination, actions):
+        renames = [[action[1], action[2]] for action in actions if action[0] == 'rename']
+        if renames:
+            destination.rename_files(renames)
+
+    def copy_and_delete(destination, actions):
+        copies = [action[1] for action in actions if action[0] in ('copy', 'update')]
+        if copies:
+            destination.copy_files_from_storage(copies)
+        deletes = [action[1] for action in actions if action[0] == 'delete']
+        if deletes:
+            destination.delete_files(deletes)
+
+    with ThreadPoolExecutor(max_workers=max(1, len(destinations))) as executor:
+        list(executor.map(rename, destinations, actions_lists))
+        if staged:
+            source.copy_files_to_storage(staged)
+        list(executor.map(copy_and_delete, destinations, actions_lists))
+
+
+def schedule(actions, source, destination, scheduler):
+    """This method runs the copies and deletes from the actions returned by plan with the scheduler given as parameter.
+    The sizes of the files are taken from a single listing of the source location.
+    If the destination is rewritten by each write, like a zip, the scheduler only stages the files in the storage
+    and they are written to the destination in a single batch after it ran, followed by the deletes."""
+    copies = [action for action in actions if action[0] in ('copy', 'update')]
+    deletes = [action[1] for action in actions if action[0] == 'delete']
+    batched = destination.type.rewrites_on_write()
+    directories = [action[1] for action in copies if action[1].endswith('/')]
+    if batched and directories:
+        source.copy_files_to_storage(directories)
+    elif directories:
+        for directory in directories:
+            source.transfer_to(destination, directory)
+    sizes = {entry.path: entry.size for entry in source.iter_entries()} if copies else {}
+    for action in copies:
+        if action[1].endswith('/'):
+            continue
+        if batched:
+            scheduler.copy_to_storage(source, action[1], sizes.get(action[1], 0))
+        else:
+            scheduler.transfer(source, destination, action[1], sizes.get(action[1], 0), action[0] == 'update')
+    if not batched:
+        for file in deletes:
+            scheduler.delete(destination, file)
+    scheduler.run()
+    if batched:
+        if copies:
+            destination.copy_files_from_storage([action[1] for action in copies])
+        if deletes:
+            destination.delete_files(deletes)
@@ -0,0 +1,281 @@
+import heapq
+import threading
+import time
+
+chunk_size: int = 1024 * 1024
+"""the memory a running transfer is counted for, as the streams are read and written one chunk of this size at a time.
+It is an estimate: the memory really held is not measured, a delta keeps a few chunks and the signature of the old
+copy, and a zip member compressed by a worker process of rsync_zip is held whole."""
+
+large_file_size: int = 16 * 1024 * 1024
+"""the files of at least this size are transferred after all the smaller ones were started"""
+
+default_limits = {'folder': 4, 'zip': 1, 'ftp': 4}
+"""the maximum number of locations used at the same time on each backend by the running operations.
+A zip is rewritten by its writes, so only one of them can run at a time. A transfer between two ftp locations
+holds a connection for each of them, so it takes two of the ftp places: the ftp limit must not be above
+the max_size of the rsync_ftp connection pool, or the transfers could wait for each other's connections forever."""
+
+
+class TokenBucket:
+    """This class limits the bytes per second going through it. Each transfer takes tokens for the bytes it moves
+    and the bucket is refilled at rate tokens per second, up to burst tokens, so short bursts are allowed.
+    A transfer which takes more tokens than there are waits until its debt is paid back."""
+
+    def __init__(self, rate: float = None, burst: float = None):
+        """Constructor that sets the rate in bytes per second given as parameter (None for no limit)
+        and the burst in bytes (one second of rate by default)"""
+        self.rate = rate
+        self.burst = burst if burst is not None else (rate or 0)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount: int):
+        """This method takes amount tokens from the bucket, waiting as long as needed to stay under the rate"""
+        if self.rate is None or amount <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Progress:
+    """This class counts the files and bytes transferred by a scheduler and estimates the time left"""
+
+    def __init__(self):
+        """Constructor that creates an empty progress"""
+        self.files_total = 0
+        self.files_done = 0
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self.started = None
+
+    def elapsed(self):
+        """This method returns the seconds since the transfers started"""
+        return time.monotonic() - self.started if self.started is not None else 0.0
+
+    def rate(self):
+        """This method returns the average bytes per second since the transfers started"""
+        elapsed = self.elapsed()
+        return self.bytes_done / elapsed if elapsed > 0 else 0.0
+
+    def eta(self):
+        """This method returns the estimated seconds until all the bytes are transferred
+        OR None if it is not known yet"""
+        rate = self.rate()
+        if rate <= 0:
+            return None
+        return (self.bytes_total - self.bytes_done) / rate
+
+    def __str__(self):
+        eta = self.eta()
+        return (f"{self.files_done}/{self.files_total} files, "
+                f"{self.bytes_done / 1e6:.1f}/{self.bytes_total / 1e6:.1f} MB, {self.rate() / 1e6:.2f} MB/s, "
+                f"ETA {'?' if eta is None else f'{eta:.0f}s'}")
+
+
+class ThrottledStream:
+    """This class wraps a readable binary stream so every chunk read from it goes through the token bucket
+    of a scheduler and is counted in its progress"""
+
+    def __init__(self, stream, scheduler, counted: list):
+        """Constructor that wraps the stream given as parameter for the scheduler given as parameter.
+        The bytes read are also added to counted[0], so the caller knows how many were already counted."""
+        self.stream = stream
+        self.scheduler = scheduler
+        self.counted = counted
+
+    def read(self, size: int = -1):
+        data = self.stream.read(size)
+        self.counted[0] += len(data)
+        self.scheduler.account(len(data))
+        return data
+
+
+class Scheduler:
+    """This class runs the transfers and deletes of a synchronisation on a pool of threads.
+    The deletes and directories run first, then the small files from the smallest one, then the large files,
+    so a big file never holds back thousands of small ones. The bytes per second, the operations running at the same
+    time on each backend and the memory of the running transfers are limited, and the progress can be followed.
+    The memory limit is a simplification: each transfer is counted for at most chunk_size bytes, whatever its
+    locations really buffer, and the large files are not split, they are only started after the small ones.
+    The operations are added first and then they are all run by calling run."""
+
+    def __init__(self, workers: int = 4, bandwidth: float = None, limits: dict = None,
+                 memory_limit: int = 64 * 1024 * 1024, on_progress=None):
+        """Constructor that sets the number of threads, the bandwidth in bytes per second (None for no limit),
+        the backends limits (a dictionary like default_limits, updating it), the maximum bytes counted for the
+        running transfers (chunk_size at most for each one) and a function called with the Progress object every
+        time bytes are transferred."""
+        self.workers = workers
+        self.limits = dict(default_limits)
+        if limits is not None:
+            self.limits.update(limits)
+        self.memory_limit = memory_limit
+        self.bucket = TokenBucket(bandwidth)
+        self.progress = Progress()
+        self.on_progress = on_progress
+        self._condition = threading.Condition()
+        self._queues = {}
+        """maps a tuple of backends names to the heap of the operations using those backends"""
+        self._running = {}
+        """maps a backend name to the number of its places taken by the operations running now"""
+        self._memory = 0
+        self._sequence = 0
+        self._error = None
+
+    @staticmethod
+    def priority(file: str, size: int):
+        """This method returns the priority of an operation on the file given as parameter, the lowest running first:
+        0 for the directories and the deletes, 1 for the small files and 2 for the large ones"""
+        if file.endswith('/'):
+            return 0
+        return 1 if size < large_file_size else 2
+
+    def _add(self, priority: int, size: int, locations, function, *args):
+        """This method queues the function given as parameter to be called with args on the locations given.
+        The operation takes a place of its backend for each of its locations, but never more than the backend limit,
+        so a copy inside a single zip can still run."""
+        names = [location.type.name.lower() for location in locations]
+        backends = tuple(sorted(set(names)))
+        places = tuple((backend, min(names.count(backend), self.limits.get(backend, self.workers)))
+                       for backend in backends)
+        memory = min(size, chunk_size)
+        with self._condition:
+            self._sequence += 1
+            heapq.heappush(self._queues.setdefault(backends, []),
+                           (priority, size, self._sequence, memory, backends, places, function, args))
+            if function != self.delete_now:
+                self.progress.files_total += 1
+                self.progress.bytes_total += size
+            self._condition.notify()
+
+    def transfer(self, source, destination, file: str, size: int, delta: bool = False):
+        """This method queues the copy of the file of size bytes given as parameter from the source location to the
+        destination location. It is streamed through the bandwidth limit when both locations can stream it.
+        If delta is True, only the changed blocks are written when the destination can be patched."""
+        self._add(self.priority(file, size), size, (source, destination), self.transfer_now, source, destination,
+                  file, size, delta)
+
+    def copy_to_storage(self, location, file: str, size: int):
+        """This method queues the copy of the file of size bytes given as parameter from the location to the storage"""
+        self._add(self.priority(file, size), size, (location,), self.staged_now, location.copy_file_to_storage,
+                  file, size)
+
+    def copy_from_storage(self, location, file: str, size: int):
+        """This method queues the copy of the file of size bytes given as parameter from the storage to the location"""
+        self._add(self.priority(file, size), size, (location,), self.staged_now, location.copy_file_from_storage,
+                  file, size)
+
+    def delete(self, location, file: str):
+        """This method queues the delete of the file given as parameter from the location given as parameter"""
+        self._add(0, 0, (location,), self.delete_now, location, file)
+
+    def account(self, size: int):
+        """This method counts size bytes as transferred, waiting for the bandwidth limit, and reports the progress"""
+        self.bucket.consume(size)
+        with self._condition:
+            self.progress.bytes_done += size
+        if self.on_progress is not None:
+            self.on_progress(self.progress)
+
+    def transfer_now(self, source, destination, file: str, size: int, delta: bool = False):
+        """This method transfers the file given as parameter, counting the bytes as they are streamed"""
+        counted = [0]
+
+        def wrap(stream):
+            return ThrottledStream(stream, self, counted)
+
+        if delta:
+            source.delta_transfer_to(destination, file, wrap)
+        else:
+            source.transfer_to(destination, file, wrap)
+        # the bytes which were not streamed, like the ones of a folder going through the storage, are only known now
+        self.account(max(0, size - counted[0]))
+
+    def staged_now(self, copy, file: str, size: int):
+        """This method calls the storage copy given as parameter for the file given as parameter,
+        counting the bytes as they are streamed when the location can stream them"""
+        counted = [0]
+
+        def wrap(stream):
+            return ThrottledStream(stream, self, counted)
+
+        copy(file, wrap)
+        self.account(max(0, size - counted[0]))
+
+    def delete_now(self, location, file: str):
+        """This method deletes the file given as parameter from the location given as parameter"""
+        location.delete_file(file)
+
+    def _can_start(self, operation):
+        """This method checks if the operation given as parameter fits in the backends and memory limits.
+        It must be called while holding the lock."""
+        priority, size, sequence, memory, backends, places, function, args = operation
+        for backend, count in places:
+            if self._running.get(backend, 0) + count > self.limits.get(backend, self.workers):
+                return False
+        # an operation bigger than the whole memory limit can still run, but only alone
+        return self._memory + memory <= self.memory_limit or self._memory == 0
+
+    def _next(self):
+        """This method waits for the next operation which can start and returns it, OR None if there is nothing
+        left to start or an operation failed. The first operation of each group of backends is the only candidate
+        of its group, so choosing one costs the same however many operations are queued."""
+        with self._condition:
+            while True:
+                if self._error is not None or not any(self._queues.values()):
+                    return None
+                candidates = [queue[0] for queue in self._queues.values() if queue and self._can_start(queue[0])]
+                if candidates:
+                    operation = min(candidates)
+                    heapq.heappop(self._queues[operation[4]])
+                    for backend, count in operation[5]:
+                        self._running[backend] = self._running.get(backend, 0) + count
+                    self._memory += operation[3]
+                    return operation
+                self._condition.wait()
+
+    def _finish(self, operation, error: BaseException = None):
+        """This method gives back the limits taken by the operation given as parameter when it ended"""
+        with self._condition:
+            for backend, count in operation[5]:
+                self._running[backend] -= count
+            self._memory -= operation[3]
+            if operation[6] != self.delete_now:
+                self.progress.files_done += 1
+            if error is not None and self._error is None:
+                self._error = error
+            self._condition.notify_all()
+
+    def _work(self):
+        """This method runs operations on the current thread until there are none left"""
+        while True:
+            operation = self._next()
+            if operation is None:
+                return
+            try:
+                operation[6](*operation[7])
+            except BaseException as error:
+                self._finish(operation, error)
+            else:
+                self._finish(operation)
+
+    def run(self):
+        """This method runs all the queued operations and returns when they ended.
+        If an operation fails, no other one is started and its error is raised once the running ones ended."""
+        self.progress.started = time.monotonic()
+        threads = [threading.Thread(target=self._work, daemon=True) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
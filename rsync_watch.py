@@ -0,0 +1,100 @@
+import os
+import threading
+import time
+import zipfile as zip
+from rsync_location import Location, LocationType
+
+
+def diff_snapshots(old: dict, new: dict):
+    """This method returns a list of [relative path, change] lists sorted by path, describing what changed
+    from the old snapshot to the new one, where change is 'added', 'deleted' or 'changed'."""
+    changes = []
+    for path in sorted(set(old) | set(new)):
+        if path not in old:
+            changes.append([path, 'added'])
+        elif path not in new:
+            changes.append([path, 'deleted'])
+        elif old[path] != new[path]:
+            changes.append([path, 'changed'])
+    return changes
+
+
+class Watcher:
+    """This class watches a location and produces the changes made to it, so the synchronisation handles only them.
+    The location is checked by comparing stat snapshots, with a cheap os.stat check first for the zip locations.
+    A change is produced only after the location stayed the same for debounce seconds, so files still being
+    written are not read, and the time between checks doubles up to max_interval while nothing changes."""
+
+    def __init__(self, location: Location, interval: float = 1.0, max_interval: float = 30.0,
+                 debounce: float = 2.0):
+        """Constructor that takes the first snapshot of the location given as parameter.
+        The changes are the ones made after this snapshot."""
+        self.location = location
+        self.interval = interval
+        self.max_interval = max_interval
+        self.debounce = debounce
+        self._stopped = threading.Event()
+        self._pending = None
+        self._pending_since = 0.0
+        self._last_signature = self._signature()
+        self._reported = self.location.stat_snapshot()
+
+    def _signature(self):
+        """This method returns a value which changes when the zip archive changes,
+        OR None for the locations that can not be checked without a snapshot."""
+        if self.location.type == LocationType.ZIP:
+            try:
+                result = os.stat(self.location.path)
+                return result.st_size, result.st_mtime_ns
+            except OSError:
+                return None
+        return None
+
+    def poll(self):
+        """This method checks the location once and returns the list of [relative path, change] lists
+        made since the last reported changes, which is empty if nothing changed or the changes are not settled yet."""
+        signature = self._signature()
+        if signature is not None and signature == self._last_signature and self._pending is None:
+            return []
+        try:
+            snapshot = self.location.stat_snapshot()
+        except (OSError, EOFError, zip.BadZipFile):
+            # the location is being written, it is checked again later
+            return []
+
+        if snapshot == self._reported:
+            self._pending = None
+            self._last_signature = signature
+            return []
+        now = time.monotonic()
+        if self._pending is None or snapshot != self._pending:
+            self._pending = snapshot
+            self._pending_since = now
+            return []
+        if now - self._pending_since < self.debounce:
+            return []
+
+        changes = diff_snapshots(self._reported, snapshot)
+        self._reported = snapshot
+        self._pending = None
+        self._last_signature = signature
+        return changes
+
+    def watch(self):
+        """This method is a generator giving the list of changes each time the location changed, until stop is called.
+        The location is checked every interval seconds while it changes and less often while it does not."""
+        interval = self.interval
+        while not self._stopped.is_set():
+            changes = self.poll()
+            if changes:
+                interval = self.interval
+                yield changes
+            elif self._pending is not None:
+                interval = min(self.interval, self.debounce)
+            else:
+                interval = min(interval * 2, self.max_interval)
+            self._stopped.wait(interval)
+
+    def stop(self):
+        """This method makes watch return, it can be called from another thread"""
+        self._stopped.set()
@@ -1,62 +1,316 @@
+import collections
+import copy
 import hashlib
+import math
 import os
+import shutil
+import struct
+import tempfile
+import time
 import zipfile as zip
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+import rsync_hash
+import rsync_metrics as metrics
+from rsync_entry import FileEntry, sort_key
+from rsync_manifest import Manifest, metadata_signature
 
 storage_path: str = "E:\\Info\\FACULTATE\\ANUL_3\\PYTHON\\PROIECT\\Advanced RSync\\storage"
 
+_chunk_size: int = 1024 * 1024
+"""the number of decompressed bytes read at once from a zip member when hashing it"""
+
+mtime_precision: float = 2.0
+"""the seconds the modification time of a member can be off by, the zip format keeping it with 2 seconds"""
+
+retries: int = 5
+"""how many times reading a locked or half written archive is tried again before giving up"""
+
+debounce: float = 1.0
+"""the seconds an archive size and modification time must stay the same before it is read again after a failure"""
+
+compression: int = zip.ZIP_DEFLATED
+"""the compression method of the members written in the zips which have no method set with set_compression"""
+
+compresslevel: int = None
+"""the compression level of the members written in the zips which have no level set with set_compression,
+None being the default level of the method"""
+
+compression_workers: int = os.cpu_count() or 1
+"""the number of processes compressing the members added to a zip at the same time, 1 to compress them in this one"""
+
+parallel_size_limit: int = 64 * 1024 * 1024
+"""the files bigger than this are compressed while being written by this process instead of in memory by a worker"""
+
+parallel_memory_limit: int = 256 * 1024 * 1024
+"""the most bytes of the files compressed by the workers or waiting to be written at the same time, as each one is
+held whole in memory: a file waits until the ones before it are written if it does not fit"""
+
+stored_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.mp4', '.mkv', '.avi', '.mov', '.ogg',
+                     '.flac', '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.zst', '.jar', '.docx', '.xlsx',
+                     '.pptx', '.pdf'}
+"""the extensions of the files which are already compressed, so they are stored in the zips without compressing them"""
+
+entropy_threshold: float = 7.5
+"""the bits of entropy per byte above which the sample of a file is considered random, so the file is stored"""
+
+_sample_size: int = 64 * 1024
+
+_compression = {}
+"""maps the absolute path of a zip to the (compression method, compression level) set for it with set_compression"""
+
+
+def wait_until_stable(zip_path: str, timeout: float = 30.0):
+    """This method waits until the size and modification time of the zip at the path given as parameter
+    did not change for debounce seconds, or at most timeout seconds, so an archive still being written is not read."""
+    deadline = time.monotonic() + timeout
+    last = None
+    stable_since = time.monotonic()
+    while time.monotonic() < deadline:
+        try:
+            result = os.stat(zip_path)
+            current = (result.st_size, result.st_mtime_ns)
+        except OSError:
+            current = None
+        if current != last:
+            last = current
+            stable_since = time.monotonic()
+        elif time.monotonic() - stable_since >= debounce:
+            return
+        time.sleep(debounce / 4)
+
+
+def with_retries(function, *args):
+    """This method calls the function given as parameter with the args given as parameter, calling it again
+    if the archive can not be read, at most retries times, after waiting for the archive to stop changing."""
+    for attempt in range(retries + 1):
+        try:
+            return function(*args)
+        except (OSError, EOFError, zip.BadZipFile):
+            if attempt == retries:
+                raise
+            metrics.count('zip', 'retries')
+            wait_until_stable(args[0])
+
+
+def set_compression(zip_path: str, method: int = None, level: int = None):
+    """This method sets the compression method (zipfile.ZIP_STORED, ZIP_DEFLATED, ZIP_BZIP2 or ZIP_LZMA)
+    and level of the members written from now on in the zip at zip_path parameter.
+    Passing None for the method goes back to the module compression and compresslevel."""
+    if method is None:
+        _compression.pop(os.path.abspath(zip_path), None)
+    else:
+        _compression[os.path.abspath(zip_path)] = (method, level)
+
+
+def get_compression(zip_path: str):
+    """This method returns the (compression method, compression level) tuple used for the zip at zip_path parameter"""
+    return _compression.get(os.path.abspath(zip_path), (compression, compresslevel))
+
+
+def is_compressible(sample: bytes):
+    """This method checks if the sample of a file given as parameter is worth compressing,
+    computing the entropy of its bytes: the compressed and random looking data is close to 8 bits per byte."""
+    if len(sample) == 0:
+        return True
+    entropy = 0.0
+    for count in collections.Counter(sample).values():
+        probability = count / len(sample)
+        entropy -= probability * math.log2(probability)
+    return entropy < entropy_threshold
+
+
+def choose_method(file: str, method: int, sample: bytes = None):
+    """This method returns the compression method of the member given as parameter: ZIP_STORED if its extension
+    is one of the stored_extensions or if the sample of its content given as parameter is not compressible,
+    otherwise the method given as parameter."""
+    if method == zip.ZIP_STORED or os.path.splitext(file)[1].lower() in stored_extensions:
+        return zip.ZIP_STORED
+    if sample is not None and not is_compressible(sample):
+        return zip.ZIP_STORED
+    return method
+
+
+def compress_file(local_path: str, file: str, method: int, level: int = None):
+    """This method reads the local file given as parameter and returns a (compression method, CRC, size,
+    compressed bytes) tuple for writing it as the member given as parameter, choosing ZIP_STORED if it is not
+    compressible. It is run by the worker processes, so it only gets and returns values that can be pickled."""
+    with open(local_path, 'rb') as source:
+        content = source.read()
+    method = choose_method(file, method, content[:_sample_size])
+    compressor = zip._get_compressor(method, level)
+    data = content if compressor is None else compressor.compress(content) + compressor.flush()
+    return method, zip.crc32(content), len(content), data
+
+
+def write_compressed_member(archive: zip.ZipFile, file: str, local_path: str, compressed):
+    """This method writes in the opened archive the member given as parameter with the (compression method, CRC,
+    size, compressed bytes) tuple returned by compress_file, taking the date and attributes from the local file."""
+    method, crc, size, data = compressed
+    info = zip.ZipInfo.from_file(local_path, file)
+    info.compress_type = method
+    if method == zip.ZIP_LZMA:
+        info.flag_bits |= zip._MASK_COMPRESS_OPTION_1
+    info.CRC = crc
+    info.file_size = size
+    info.compress_size = len(data)
+    start_raw_member(archive, info)
+    archive.fp.write(data)
+    end_raw_member(archive, info)
+    metrics.add_bytes('zip', written=size)
+
+
+def write_local_file(archive: zip.ZipFile, file: str, local_path: str, zip_path: str = None):
+    """This method writes the local file or folder given as parameter in the opened archive as the member file,
+    compressing it while it is read with the compression of the zip at zip_path parameter (the archive by default)."""
+    if os.path.isdir(local_path):
+        archive.write(local_path, file)
+        return
+    method, level = get_compression(zip_path or archive.filename)
+    with open(local_path, 'rb') as source:
+        sample = source.read(_sample_size)
+    archive.write(local_path, file, choose_method(file, method, sample), level)
+    metrics.add_bytes('zip', written=archive.getinfo(file).file_size)
+
+
+def write_local_files(archive: zip.ZipFile, files, zip_path: str = None):
+    """This method writes in the opened archive the (member, local path) tuples given as parameter, in order,
+    with the compression of the zip at zip_path parameter (the archive by default).
+    The files are compressed at the same time by compression_workers processes and written as they are ready,
+    at most two files for each worker and parallel_memory_limit bytes of them being kept in memory.
+    The folders, the files bigger than parallel_size_limit and the files stored because of their extension
+    are written by this process, streamed from their local path."""
+    files = list(files)
+    method, level = get_compression(zip_path or archive.filename)
+    parallel = []
+    """the [index, size] lists of the files compressed by the workers"""
+    for index, (file, local_path) in enumerate(files):
+        if os.path.isfile(local_path) and choose_method(file, method) != zip.ZIP_STORED:
+            size = os.path.getsize(local_path)
+            if size <= parallel_size_limit:
+                parallel.append([index, size])
+    if compression_workers <= 1 or len(parallel) < 2:
+        for file, local_path in files:
+            write_local_file(archive, file, local_path, zip_path)
+        return
+
+    with ProcessPoolExecutor(max_workers=compression_workers) as executor:
+        pending = collections.deque()
+        waiting = collections.deque(parallel)
+        in_flight = 0
+        for index, (file, local_path) in enumerate(files):
+            while waiting and len(pending) < 2 * compression_workers and \
+                    (not pending or in_flight + waiting[0][1] <= parallel_memory_limit):
+                submitted, size = waiting.popleft()
+                pending.append((submitted, size, executor.submit(compress_file, files[submitted][1],
+                                                                 files[submitted][0], method, level)))
+                in_flight += size
+            if pending and pending[0][0] == index:
+                submitted, size, future = pending.popleft()
+                write_compressed_member(archive, file, local_path, future.result())
+                in_flight -= size
+            else:
+                write_local_file(archive, file, local_path, zip_path)
+
+
+def md5_member(archive: zip.ZipFile, file_name, hash_md5):
+    """This method receives a relative path in file_name from the already opened zip given in archive
+    and updates the hash_md5 parameter, which can be any hashlib object, by reading the decompressed file."""
+    with archive.open(file_name) as file:
+        rsync_hash.update_from_stream(hash_md5, file, lambda size: metrics.add_bytes('zip', read=size))
+
 
 def md5(zip_path, file_name, hash_md5):
     """This method receives a relative path in file_path from the zip file,and the zip path given in zip_path
-    and updates the hash_md5 parameter by opening the file from the zip and reading chunks of 4096 bytes."""
+    and updates the hash_md5 parameter by opening the file from the zip and reading it in chunks.
+    When hashing more files from the same zip, md5_member should be used on a single opened archive."""
     with zip.ZipFile(zip_path, 'r') as archive:
-        with archive.open(file_name) as file:
-            for chunk in iter(lambda: file.read(4096), b""):
-                hash_md5.update(chunk)
+        md5_member(archive, file_name, hash_md5)
 
 
-def get_hash(zip_path: str):
+def get_hash(zip_path: str, manifest: Manifest = None):
     """This method returns the md5 hash for the zip from the path given as parameter.
        The hash is created from the relative path of the files sorted and then,
-       for each file in sorted order, hashing chunks of 4096 bytes."""
-    hash_md5 = hashlib.md5()
+       for each file in sorted order, hashing its content.
+       The archive is opened and its central directory is read only once.
+       If a manifest is given and no file changed its size or modification time, the remembered hash is returned."""
+    return with_retries(read_hash, zip_path, manifest)
 
-    files_paths = []
-    while 1:
-        try:
-            with zip.ZipFile(zip_path, "r") as archive:
-                namesList = archive.namelist()
-                for file in namesList:
-                    if not file.endswith('/'):
-                        files_paths.append(file)
-            archive.close()
-            break
-        except Exception:
-            pass
-
-    files_list = get_files_list(zip_path)
-    files_list.sort()
-    for file in files_list:
-        hash_md5.update(file.encode('UTF-8'))
-
-    files_paths.sort()
-    for file in files_paths:
-        md5(zip_path, file, hash_md5)
 
+def read_hash(zip_path: str, manifest: Manifest = None):
+    """This method computes the hash returned by get_hash, without trying again if the archive can not be read."""
+    with zip.ZipFile(zip_path, "r") as archive:
+        if manifest is not None:
+            signature = metadata_signature([info.filename, info.file_size, get_mtime(info)]
+                                           for info in archive.infolist())
+            newest = max((get_mtime(info) for info in archive.infolist()), default=None)
+            tree_hash = manifest.get_tree_hash(signature)
+            if tree_hash is not None:
+                return tree_hash
+        hash_md5 = hashlib.md5()
+        files_list = archive.namelist()
+        for file in sorted(files_list):
+            hash_md5.update(file.encode('UTF-8'))
+        for file in sorted(file for file in files_list if not file.endswith('/')):
+            md5_member(archive, file, hash_md5)
+    if manifest is not None:
+        manifest.set_tree_hash(signature, hash_md5.hexdigest(), newest)
     return hash_md5.hexdigest()
 
 
+def get_mtime(info: zip.ZipInfo):
+    """This method returns the modification time of the zip member given as parameter in seconds since epoch"""
+    return time.mktime(info.date_time + (0, 0, -1))
+
+
+def hash_members(zip_path: str, known: dict = None, manifest: Manifest = None):
+    """This method returns a dictionary mapping each file relative path from the zip at the path given as parameter
+    to a (CRC, file size, hash) tuple, opening the archive only once.
+    The known parameter is a dictionary like the one returned by a previous call: a file whose CRC and size
+    are the same as the known ones gets its known hash back without being decompressed.
+    If a manifest is given, the files whose size and modification time did not change are not decompressed either."""
+    with zip.ZipFile(zip_path, "r") as archive:
+        return hash_archive_members(archive, known, manifest)
+
+
+def hash_archive_members(archive: zip.ZipFile, known: dict = None, manifest: Manifest = None):
+    """This method does the same thing as hash_members for the already opened zip given in archive."""
+    members = {}
+    for info in archive.infolist():
+        if info.is_dir():
+            continue
+        if known is not None and info.filename in known:
+            crc, size, file_hash = known[info.filename]
+            if crc == info.CRC and size == info.file_size:
+                members[info.filename] = (crc, size, file_hash)
+                if manifest is not None:
+                    manifest.set_hash(info.filename, info.file_size, get_mtime(info), file_hash)
+                continue
+        if manifest is not None:
+            file_hash = manifest.get_hash(info.filename, info.file_size, get_mtime(info))
+            if file_hash is not None:
+                members[info.filename] = (info.CRC, info.file_size, file_hash)
+                continue
+        digest = rsync_hash.new()
+        md5_member(archive, info, digest)
+        file_hash = rsync_hash.label(digest.hexdigest())
+        members[info.filename] = (info.CRC, info.file_size, file_hash)
+        if manifest is not None:
+            manifest.set_hash(info.filename, info.file_size, get_mtime(info), file_hash)
+    return members
+
+
 def get_files_list(zip_path: str):
     """This method returns a list with all the files relative path of zip at the path given as parameter
     The paths returned have a specific syntax in order to be correlate with other locations structures."""
-    files_list = []
-    while 1:
-        try:
-            with zip.ZipFile(zip_path, "r") as archive:
-                for file_path in archive.namelist():
-                    files_list.append(file_path)
-            return files_list
-        except Exception:
-            pass
+    return with_retries(read_files_list, zip_path)
+
+
+def read_files_list(zip_path: str):
+    """This method reads the list returned by get_files_list, without trying again if the archive can not be read."""
+    with zip.ZipFile(zip_path, "r") as archive:
+        return archive.namelist()
 
 
 def get_last_modification_date_of_file(zip_path: str, file: str):
@@ -78,27 +332,75 @@ def get_last_modification_date_of_file(zip_path: str, file: str):
         return f"{year}-{month}-{day} {hours}:{minutes}:{seconds}"
 
 
-def get_files_with_hash(zip_path):
+def stat_snapshot(zip_path: str):
+    """This method returns a dictionary mapping every file and directory relative path of the zip at the path given
+    as parameter to a [size, modification time in seconds since epoch, 'file' or 'directory'] list,
+    reading the central directory of the archive only once."""
+    snapshot = {}
+    with zip.ZipFile(zip_path, "r") as archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                snapshot[info.filename] = [0, get_mtime(info), 'directory']
+            else:
+                snapshot[info.filename] = [info.file_size, get_mtime(info), 'file']
+    return snapshot
+
+
+def get_files_with_hash(zip_path, known: dict = None, manifest: Manifest = None):
     """This method returns a list of lists where
     the first element in each list is a file relative path from the zip (similar to get files list)
-    and the second element is that file's hash."""
+    and the second element is that file's hash.
+    The known and manifest parameters are passed to hash_members to skip decompressing the files that did not change."""
     files_list = []
     with zip.ZipFile(zip_path, "r") as archive:
+        members = hash_archive_members(archive, known, manifest)
         for file_path in archive.namelist():
-
             if not file_path.endswith('/'):
-                hash_md5 = hashlib.md5()
-                md5(zip_path, file_path, hash_md5)
-                file_hash = hash_md5.hexdigest()
+                file_hash = members[file_path][2]
             else:
                 file_hash = "directory"
             files_list.append([file_path, file_hash])
+    if manifest is not None:
+        manifest.forget_unseen()
     return files_list
 
 
-def copy_to_storage(zip_path: str, file: str):
+def hash_entry(archive: zip.ZipFile, zip_path: str, info: zip.ZipInfo, manifest: Manifest = None):
+    """This method returns the hash of the zip member given in info, reading it from the opened zip given
+    in archive, or from the zip at zip_path if the archive was closed in the meantime.
+    If a manifest is given, the member is decompressed only if its size or modification time changed."""
+    if manifest is not None:
+        file_hash = manifest.get_hash(info.filename, info.file_size, get_mtime(info))
+        if file_hash is not None:
+            return file_hash
+    digest = rsync_hash.new()
+    if archive.fp is None:
+        md5(zip_path, info.filename, digest)
+    else:
+        md5_member(archive, info, digest)
+    file_hash = rsync_hash.label(digest.hexdigest())
+    if manifest is not None:
+        manifest.set_hash(info.filename, info.file_size, get_mtime(info), file_hash)
+    return file_hash
+
+
+def iter_entries(zip_path: str, manifest: Manifest = None):
+    """This generator yields a FileEntry for every member of the zip at the path given as parameter
+    in sort_key order, with the hash computed only when it is asked for.
+    The archive stays opened while the entries are consumed, so the hashes do not open it again."""
+    with zip.ZipFile(zip_path, "r") as archive:
+        for info in sorted(archive.infolist(), key=lambda info: sort_key(info.filename)):
+            if info.is_dir():
+                yield FileEntry(info.filename, True, 0, get_mtime(info))
+            else:
+                yield FileEntry(info.filename, False, info.file_size, get_mtime(info),
+                                partial(hash_entry, archive, zip_path, info, manifest))
+
+
+def copy_to_storage(zip_path: str, file: str, wrap=None):
     """This method copies the file given as parameter from the zip at the path given as parameter to the storage
-    If the file is a folder, it copies the files inside it."""
+    If the file is a folder, it copies the files inside it. The wrap parameter is a function which receives
+    the stream read from the zip and returns the one written to the storage."""
     file = file.replace("/", "\\")
     if file.endswith('\\'):
         file = file.removesuffix('\\')
@@ -108,7 +410,14 @@ def copy_to_storage(zip_path: str, file: str):
         with zip.ZipFile(zip_path, "r") as archive:
             for file_path in archive.namelist():
                 if file_path.replace("/", "\\") == file:
-                    archive.extract(file_path, storage_path)
+                    if wrap is None:
+                        archive.extract(file_path, storage_path)
+                    else:
+                        local_path = os.path.join(storage_path, *file_path.split('/'))
+                        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                        with archive.open(file_path) as source, open(local_path, 'wb') as target:
+                            shutil.copyfileobj(wrap(source), target, _chunk_size)
+                    metrics.add_bytes('zip', read=archive.getinfo(file_path).file_size)
                     return
 
 
@@ -117,31 +426,226 @@ def copy_from_storage(zip_path: str, file: str):
     If the file is a folder, it copies the files inside it."""
     path = storage_path + '\\' + file
 
-    archive = zip.ZipFile(zip_path, "a")
-    if file in archive.namelist():
-        archive.close()
-        delete_file(zip_path, file)
-        archive = zip.ZipFile(zip_path, "a")
+    with zip.ZipFile(zip_path, "a") as archive:
+        if file not in archive.namelist():
+            write_local_file(archive, file, path)
+            return
+
+    with ZipUpdate(zip_path) as update:
+        update.add(file, path)
+
+
+@contextmanager
+def open_file(zip_path: str, file: str):
+    """This method is used in a with statement to read the file given as parameter from the zip at zip_path parameter
+    without extracting it. It gives a (readable binary stream, file size) tuple."""
+    with zip.ZipFile(zip_path, "r") as archive:
+        info = archive.getinfo(file)
+        with archive.open(info) as stream:
+            yield stream, info.file_size
+        metrics.add_bytes('zip', read=info.file_size)
+
+
+def write_file(zip_path: str, file: str, stream, size: int = None):
+    """This method writes the file given as parameter in the zip at zip_path parameter with the content read
+    from the binary stream given as parameter in chunks of _chunk_size bytes, replacing it if it exists.
+    The size parameter is the number of bytes in the stream, if it is known."""
+    with zip.ZipFile(zip_path, "a") as archive:
+        if file not in archive.namelist():
+            write_member(archive, file, stream, size)
+            return
+
+    with ZipUpdate(zip_path) as update:
+        update.add_stream(file, stream, size)
+
+
+def write_member(archive: zip.ZipFile, file: str, stream, size: int = None, zip_path: str = None):
+    """This method writes a new member in the opened archive with the content read from the stream given as parameter
+    and the compression of the zip at zip_path parameter (the archive by default).
+    The content can not be sampled before it is written, so only its extension can make it stored."""
+    info = zip.ZipInfo(file, time.localtime()[:6])
+    method, level = get_compression(zip_path or archive.filename)
+    info.compress_type = choose_method(file, method)
+    info._compresslevel = level
+    if size is not None:
+        info.file_size = size
+    with archive.open(info, 'w', force_zip64=size is None) as target:
+        shutil.copyfileobj(stream, target, _chunk_size)
+    metrics.add_bytes('zip', written=info.file_size)
+
 
-    archive.write(path, file, zip.ZIP_DEFLATED)
+def copy_files_from_storage(zip_path: str, files):
+    """This method copies all the files given as parameter from the storage into the zip at zip_path parameter
+    rewriting the archive only once."""
+    with ZipUpdate(zip_path) as update:
+        for file in files:
+            update.add(file, storage_path + '\\' + file)
 
 
 def delete_file(zip_path: str, file: str):
     """This method deletes the file given as parameter
     from the zip at zip_path given as parameter
     If the file is a folder, it deletes all the the files inside it."""
-    s = zip_path.split('\\')
-    old_zip_path = zip_path.removesuffix(s[len(s) - 1])
+    with ZipUpdate(zip_path) as update:
+        update.delete(file)
 
-    os.rename(zip_path, old_zip_path + "old.zip")
-    old = zip.ZipFile(old_zip_path + "old.zip", 'r')
-    new = zip.ZipFile(zip_path, 'w')
 
-    for item in old.infolist():
-        buffer = old.read(item.filename)
-        if not item.filename.startswith(file):
-            new.writestr(item, buffer)
+def delete_files(zip_path: str, files):
+    """This method deletes all the files given as parameter from the zip at zip_path given as parameter
+    rewriting the archive only once."""
+    with ZipUpdate(zip_path) as update:
+        for file in files:
+            update.delete(file)
+
+
+def rename_file(zip_path: str, file: str, new_file: str):
+    """This method renames the file given as parameter to new_file inside the zip at zip_path parameter"""
+    rename_files(zip_path, [[file, new_file]])
+
+
+def rename_files(zip_path: str, renames):
+    """This method renames all the files given as [old relative path, new relative path] lists
+    inside the zip at zip_path parameter, rewriting the zip only once"""
+    with ZipUpdate(zip_path) as update:
+        for file, new_file in renames:
+            update.rename(file, new_file)
+
+
+def copy_raw_member(old: zip.ZipFile, new: zip.ZipFile, info: zip.ZipInfo, name: str = None):
+    """This method copies the member given in info from the opened old zip to the new zip opened for writing
+    as raw compressed bytes, without decompressing and compressing it again. If a name is given,
+    the member is written under that name instead, which is how a member is renamed.
+    zipfile has no public api for this, so the local header is written and the member is registered by hand
+    the same way ZipFile.write does it."""
+    old.fp.seek(info.header_offset)
+    header = struct.unpack(zip.structFileHeader, old.fp.read(zip.sizeFileHeader))
+    old.fp.seek(header[zip._FH_FILENAME_LENGTH] + header[zip._FH_EXTRA_FIELD_LENGTH], 1)
+
+    new_info = copy.copy(info)
+    if name is not None:
+        new_info.filename = name
+        new_info.orig_filename = name
+    # the sizes and the CRC are known, so they go in the local header instead of a data descriptor
+    new_info.flag_bits &= ~0x08
+    new_info.extra = zip._strip_extra(info.extra, (1,))
+    start_raw_member(new, new_info)
+
+    remaining = info.compress_size
+    while remaining > 0:
+        chunk = old.fp.read(min(remaining, _chunk_size))
+        if not chunk:
+            raise zip.BadZipFile(f"Truncated data for member {info.filename}")
+        new.fp.write(chunk)
+        remaining -= len(chunk)
+    metrics.add_bytes('zip', read=info.compress_size, written=info.compress_size)
+    end_raw_member(new, new_info)
+
+
+def start_raw_member(archive: zip.ZipFile, info: zip.ZipInfo):
+    """This method writes the local header of the member given in info, whose CRC and sizes are already set,
+    in the archive opened for writing. Its compressed bytes must be written next, followed by end_raw_member."""
+    archive._writecheck(info)
+    archive.fp.seek(archive.start_dir)
+    info.header_offset = archive.fp.tell()
+    archive.fp.write(info.FileHeader(info.file_size > zip.ZIP64_LIMIT or info.compress_size > zip.ZIP64_LIMIT))
+
+
+def end_raw_member(archive: zip.ZipFile, info: zip.ZipInfo):
+    """This method registers the member given in info, whose bytes were just written, the same way ZipFile.write does"""
+    archive.start_dir = archive.fp.tell()
+    archive.filelist.append(info)
+    archive.NameToInfo[info.filename] = info
+    archive._didModify = True
+
+
+def is_member_of(name: str, file: str):
+    """This method checks if the member name given as parameter is the file given as parameter or, if that file
+    is a folder (ending with '/'), is inside it. A plain prefix would also match 'notes.txt.bak' for 'notes.txt'."""
+    return name == file or (file.endswith('/') and name.startswith(file))
+
+
+class ZipUpdate:
+    """This class collects the files to add, replace or delete in a zip and applies all of them in a single rewrite
+    when it is committed. The members that are not changed are copied as raw compressed bytes and the new archive
+    replaces the old one only after it was completely written.
+    It can be used in a with statement, being committed at the end of the block if no error happened."""
+
+    def __init__(self, zip_path: str):
+        """Constructor that creates an empty update for the zip at zip_path parameter"""
+        self.zip_path = zip_path
+        self._added = {}
+        """maps a file relative path in the zip to the local path its content is read from
+        or to a (binary stream, size) tuple"""
+        self._deleted = []
+        """relative paths in the zip, every member starting with one of them is deleted"""
+        self._renamed = {}
+        """maps a file relative path in the old zip to the relative path it is written under in the new zip"""
+
+    def add(self, file: str, local_path: str):
+        """This method adds the file given as parameter to the zip, or replaces it if it exists,
+        with the content of the local file at local_path. The local file is read when the update is committed."""
+        self._added[file] = local_path
+
+    def add_stream(self, file: str, stream, size: int = None):
+        """This method adds the file given as parameter to the zip, or replaces it if it exists,
+        with the content read from the binary stream given as parameter when the update is committed."""
+        self._added[file] = (stream, size)
+
+    def delete(self, file: str):
+        """This method deletes the file given as parameter from the zip.
+        If the file is a folder, it deletes all the the files inside it."""
+        for added in [added for added in self._added if is_member_of(added, file)]:
+            del self._added[added]
+        self._deleted.append(file)
+
+    def rename(self, file: str, new_file: str):
+        """This method renames the file given as parameter to new_file, replacing new_file if it exists.
+        The member is copied under the new name without being decompressed."""
+        self._added.pop(new_file, None)
+        self._renamed[file] = new_file
+
+    def _is_kept(self, file_name: str):
+        """This method checks if the member from the old zip given as parameter is copied to the new zip"""
+        if file_name in self._added or (file_name in self._renamed.values() and file_name not in self._renamed):
+            return False
+        for deleted in self._deleted:
+            if is_member_of(file_name, deleted):
+                return False
+        return True
+
+    def commit(self):
+        """This method writes the new zip next to the old one and then replaces the old one with it"""
+        if not self._added and not self._deleted and not self._renamed:
+            return
+        fd, temp_path = tempfile.mkstemp(suffix='.zip', dir=os.path.dirname(os.path.abspath(self.zip_path)))
+        os.close(fd)
+        try:
+            with zip.ZipFile(temp_path, 'w') as new:
+                if os.path.exists(self.zip_path):
+                    with zip.ZipFile(self.zip_path, 'r') as old:
+                        new.comment = old.comment
+                        for info in old.infolist():
+                            # an appended archive can have the same name more times, only the last one is read
+                            if old.getinfo(info.filename) is info and self._is_kept(info.filename):
+                                copy_raw_member(old, new, info, self._renamed.get(info.filename))
+                for file, source in self._added.items():
+                    if isinstance(source, tuple):
+                        write_member(new, file, *source, self.zip_path)
+                write_local_files(new, [(file, source) for file, source in self._added.items()
+                                        if not isinstance(source, tuple)], self.zip_path)
+            if os.path.exists(self.zip_path):
+                shutil.copymode(self.zip_path, temp_path)
+            os.replace(temp_path, self.zip_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        self._added.clear()
+        self._deleted.clear()
+        self._renamed.clear()
+
+    def __enter__(self):
+        return self
 
-    old.close()
-    os.remove(old_zip_path + "old.zip")
-    new.close()
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
@@ -0,0 +1,74 @@
+import io
+import random
+import zlib
+import pytest
+import rsync_delta as delta
+
+
+def mutate(generator: random.Random, old: bytes):
+    """This method returns a copy of the bytes given as parameter with a few random insertions, deletions and
+    replacements, like the edits of a file between two synchronisations"""
+    new = bytearray(old)
+    for _ in range(generator.randint(0, 5)):
+        operation = generator.randint(0, 2)
+        position = generator.randint(0, len(new))
+        if operation == 0:
+            new[position:position] = generator.randbytes(generator.randint(1, 3000))
+        elif operation == 1:
+            del new[position:position + generator.randint(1, 3000)]
+        else:
+            new[position:position + 10] = generator.randbytes(10)
+    return bytes(new)
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_delta_round_trip(seed, monkeypatch):
+    generator = random.Random(seed)
+    monkeypatch.setattr(delta, '_chunk_size', generator.choice([37, 500, 1024 * 1024]))
+    old = generator.randbytes(generator.randint(0, 20000))
+    new = mutate(generator, old)
+    block_size = generator.choice([16, 64, 100, 2048])
+    blocks = delta.signature(io.BytesIO(old), block_size)
+    target = io.BytesIO()
+    matched, sent = delta.patch(io.BytesIO(old), delta.delta(blocks, io.BytesIO(new), block_size), target, block_size)
+    assert target.getvalue() == new
+    assert matched + sent == len(new)
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_patch_file_round_trip(seed, tmp_path, monkeypatch):
+    generator = random.Random(seed)
+    monkeypatch.setattr(delta, '_chunk_size', generator.choice([37, 500, 1024 * 1024]))
+    monkeypatch.setattr(delta, 'max_literal_ratio', 1000.0)
+    old = generator.randbytes(generator.randint(0, 20000))
+    new = mutate(generator, old)
+    path = tmp_path / 'file'
+    path.write_bytes(old)
+    kept, written, offset = delta.patch_file(str(path), io.BytesIO(new), generator.choice([16, 64, 100, 2048]))
+    assert path.read_bytes() == new
+    assert kept + written == len(new)
+    assert old[:offset] == new[:offset]
+
+
+def test_rolling_checksum_is_adler32():
+    generator = random.Random(0)
+    block_size = 64
+    data = generator.randbytes(1000)
+    blocks = delta.signature(io.BytesIO(data[500:500 + block_size]), block_size)
+    assert blocks[0][0] == zlib.adler32(data[500:500 + block_size])
+    # the block is only found by sliding the window byte by byte from the start
+    assert ['block', 0] in list(delta.delta(blocks, io.BytesIO(data), block_size))
+
+
+def test_patch_file_gives_up_when_everything_changed(tmp_path):
+    generator = random.Random(1)
+    path = tmp_path / 'file'
+    path.write_bytes(generator.randbytes(100000))
+    assert delta.patch_file(str(path), io.BytesIO(generator.randbytes(100000))) is None
+
+
+def test_patch_file_unchanged(tmp_path):
+    data = random.Random(2).randbytes(100000)
+    path = tmp_path / 'file'
+    path.write_bytes(data)
+    assert delta.patch_file(str(path), io.BytesIO(data)) == [len(data), 0, len(data)]